@@ -0,0 +1,339 @@
+"""Streams ffmpeg output from one asyncio event loop.
+
+This is an ASGI application and it needs python 3.6 or newer, it runs apart
+from the uwsgi workers. The django views redirect the player here with a
+token signed with ASYNC_STREAM_SECRET (djmediastreamer/async_stream.py). It
+loads the django settings (main.settings unless DJANGO_SETTINGS_MODULE says
+otherwise) to share the slots, the pacing and the transcode cache with the
+workers, but not the apps or the database. Run it with any ASGI server, ie:
+
+    ASYNC_STREAM_SECRET=... uvicorn asgi_stream:app --port 8001
+
+and proxy settings.ASYNC_STREAM_URL to it."""
+import os
+import re
+import hmac
+import json
+import time
+import base64
+import asyncio
+import hashlib
+import tempfile
+from urllib.parse import parse_qs
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'main.settings')
+
+from django.conf import settings  # noqa
+
+from djmediastreamer.cache import transcode_cache  # noqa
+from djmediastreamer.fileserve import get_content_disposition  # noqa
+from djmediastreamer.pacing import BULK, LIVE, PacedStream  # noqa
+from djmediastreamer.scheduler import TranscodeScheduler  # noqa
+
+SECRET = os.environ.get('ASYNC_STREAM_SECRET', '').encode('utf8')
+if not SECRET:
+    raise RuntimeError('ASYNC_STREAM_SECRET is not set.')
+BLOCK_SIZE = int(os.environ.get('ASYNC_STREAM_BLOCK_SIZE', 64 * 1024))
+# seconds to wait after SIGTERM before sending SIGKILL
+KILL_TIMEOUT = 5
+
+
+OUTPUT_FORMATS = ('webm', 'matroska', 'mp4')
+AUDIO_CODECS = ('copy', 'aac', 'libopus')
+GOTO_RE = re.compile(r'^[0-9]+:[0-9]{2}:[0-9]{2}(\.[0-9]+)?$')
+# the files prepared by djmediastreamer.subtitles
+SUBTITLES_FILTER_RE = re.compile(r'^(subtitles|ass)=[\w/.\-]+$')
+
+
+def get_int(params, name, default=None):
+    value = params.get(name)
+    if value is None:
+        return default
+    if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+        raise ValueError(name)
+    return value
+
+
+def build_cmd(params):
+    """Returns the ffmpeg command of the parameters of a token (the same as
+    GethMediaFileView.get_transcode_cmd and get_remux_cmd). Raises ValueError
+    when one of them is not valid."""
+    full_path = params['input']
+    if not isinstance(full_path, str) or not os.path.isabs(full_path) or \
+            not os.path.isfile(full_path):
+        raise ValueError('input')
+    goto = params.get('goto')
+    if goto is not None and not GOTO_RE.match(goto):
+        raise ValueError('goto')
+    output_format = params['output_format']
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError('output_format')
+    cmd = ['ffmpeg']
+    if goto:
+        cmd.extend(['-ss', goto])
+    cmd.extend(['-i', full_path])
+    if params['mode'] == 'remux':
+        audio_codec = params.get('audio_codec', 'copy')
+        if audio_codec not in AUDIO_CODECS:
+            raise ValueError('audio_codec')
+        cmd.extend([
+            '-map', '0:v:0', '-map', '0:a:0?',
+            '-codec:v', 'copy', '-codec:a', audio_codec
+        ])
+        if audio_codec != 'copy':
+            cmd.extend(['-ac', '2', '-b:a', '128k'])
+        if output_format == 'mp4':
+            cmd.extend(['-movflags', 'frag_keyframe+empty_moov'])
+    elif params['mode'] == 'transcode' and output_format != 'mp4':
+        threads = str(get_int(params, 'threads', 1))
+        width = get_int(params, 'width')
+        height = get_int(params, 'height')
+        if output_format == 'webm':
+            if width and height:
+                cmd.extend(['-s', '{w}x{h}'.format(w=width, h=height)])
+            cmd.extend([
+                '-codec:v', 'vp8', '-b:v', '0',
+                '-crf', str(get_int(params, 'vp8_crf', 24)),
+                '-threads', threads, '-speed', '4'
+            ])
+        else:
+            cmd.extend(['-crf', '18', '-threads', threads])
+        subtitles_filter = params.get('subtitles_filter')
+        if subtitles_filter:
+            if not SUBTITLES_FILTER_RE.match(subtitles_filter):
+                raise ValueError('subtitles_filter')
+            cmd.extend(['-vf', subtitles_filter])
+    else:
+        raise ValueError('mode')
+    cmd.extend(['-y', '-f', output_format, '-'])
+    return cmd
+
+
+def load_token(token):
+    'Returns the data of a valid token or None.'
+    if '.' not in token:
+        return None
+    payload, signature = token.rsplit('.', 1)
+    payload = payload.encode('ascii')
+    expected = hmac.new(SECRET, payload, hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected, signature):
+        return None
+    data = json.loads(base64.urlsafe_b64decode(payload).decode('utf8'))
+    if data['expires'] < time.time():
+        return None
+    return data
+
+
+async def acquire_slot(scheduler):
+    'Like TranscodeScheduler.acquire, without blocking the event loop.'
+    deadline = time.time() + scheduler.queue_timeout
+    while True:
+        slot = scheduler.try_acquire()
+        if slot or time.time() >= deadline:
+            return slot
+        await asyncio.sleep(0.5)
+
+
+async def respond(send, status, headers=None):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': headers or []})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def wait_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def stop(process):
+    if process.returncode is not None:
+        return
+    process.terminate()
+    try:
+        await asyncio.wait_for(process.wait(), KILL_TIMEOUT)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+
+
+async def pace(paced, n):
+    'Waits until the PacedStream lets n more bytes go.'
+    delay = paced.take(n)
+    while delay:
+        await asyncio.sleep(delay)
+        delay = paced.take(n)
+
+
+# cache path: the SharedTranscode that is writing it
+transcodes = {}
+# cache path: Event set when the transcode that is being started is ready
+starting = {}
+
+
+class SharedTranscode(object):
+    """An ffmpeg process and its viewers, like djmediastreamer.broker does
+    for the uwsgi workers (that one needs a thread per viewer).
+
+    The output goes to a temp file of its own that every viewer reads at its
+    pace, so a paused viewer doesn't stall the others and the viewers of the
+    same cache_path can join while it runs. The process is stopped when the
+    last viewer leaves and the file goes into the transcode cache if ffmpeg
+    finished without errors."""
+
+    def __init__(self, process, cache_path=None):
+        self.process = process
+        self.cache_path = cache_path
+        if cache_path:
+            directory, name = os.path.split(cache_path)
+            fd, self.temp_path = tempfile.mkstemp(
+                prefix=name + '.', suffix='.async.part', dir=directory)
+        else:
+            fd, self.temp_path = tempfile.mkstemp(suffix='.async.part')
+        self.fd = os.fdopen(fd, 'wb')
+        self.size = 0
+        self.done = False
+        self.viewers = 0
+        self.written = asyncio.Event()
+        self.task = asyncio.ensure_future(self.pump())
+
+    def notify(self):
+        self.written.set()
+        self.written = asyncio.Event()
+
+    async def pump(self):
+        complete = False
+        try:
+            while True:
+                chunk = await self.process.stdout.read(BLOCK_SIZE)
+                if not chunk:
+                    complete = await self.process.wait() == 0
+                    break
+                self.fd.write(chunk)
+                self.fd.flush()
+                self.size += len(chunk)
+                self.notify()
+        finally:
+            self.done = True
+            self.notify()
+            self.fd.close()
+            if transcodes.get(self.cache_path) is self:
+                del transcodes[self.cache_path]
+            await stop(self.process)
+            if complete and self.cache_path:
+                # the first one that finishes is kept
+                transcode_cache.put(self.temp_path, self.cache_path)
+            else:
+                transcode_cache.discard(self.temp_path)
+
+    def attach(self):
+        'Returns the output file opened for a new viewer.'
+        self.viewers += 1
+        return open(self.temp_path, 'rb')
+
+    def detach(self):
+        self.viewers -= 1
+        if self.viewers == 0 and not self.done:
+            self.task.cancel()
+
+    async def read(self, fd, offset):
+        """Returns the output after offset (where fd is), waiting for it if
+        it was not written yet. Returns b'' when it is over."""
+        while offset >= self.size and not self.done:
+            await self.written.wait()
+        if offset >= self.size:
+            return b''
+        return fd.read(min(BLOCK_SIZE, self.size - offset))
+
+
+async def start_transcode(data, cmd):
+    'Returns a new SharedTranscode or None if there is no free slot.'
+    slot = None
+    if data.get('slots_dir'):
+        slot = await acquire_slot(TranscodeScheduler(
+            data['slots_dir'], data['slots'], data['queue_timeout']))
+        if slot is None:
+            return None
+    try:
+        # ffmpeg inherits the slot and keeps it until it exits
+        process = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+            **(slot.popen_kwargs() if slot else {}))
+    finally:
+        if slot:
+            slot.release()
+    return SharedTranscode(process, data.get('cache_path'))
+
+
+async def get_transcode(data, cmd):
+    """Returns the SharedTranscode of the token, a running one if there is
+    any, or None if there is no free slot."""
+    cache_path = data.get('cache_path')
+    if not cache_path:
+        return await start_transcode(data, cmd)
+    while cache_path not in transcodes and cache_path in starting:
+        # somebody else is starting it, join it when it is ready
+        await starting[cache_path].wait()
+    if cache_path in transcodes:
+        return transcodes[cache_path]
+    started = starting[cache_path] = asyncio.Event()
+    try:
+        shared = await start_transcode(data, cmd)
+        if shared is not None:
+            transcodes[cache_path] = shared
+    finally:
+        del starting[cache_path]
+        started.set()
+    return shared
+
+
+async def app(scope, receive, send):
+    if scope['type'] != 'http':
+        return
+    query = parse_qs(scope['query_string'].decode('ascii'))
+    try:
+        data = load_token(query.get('token', [''])[0])
+        cmd = build_cmd(data['params']) if data else None
+    except (ValueError, KeyError, TypeError):
+        data = None
+    if data is None:
+        await respond(send, 403)
+        return
+    shared = await get_transcode(data, cmd)
+    if shared is None:
+        await respond(send, 503, [(b'retry-after', b'10')])
+        return
+    fd = shared.attach()
+    # like the live transcodes of the workers: only downloads have a rate
+    if data['download']:
+        paced = PacedStream(None, settings.DOWNLOAD_MAX_RATE, kind=BULK)
+    else:
+        paced = PacedStream(None, kind=LIVE)
+    disposition = get_content_disposition(data['filename'], data['download'])
+    try:
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [
+                        (b'content-type', data['mimetype'].encode('utf8')),
+                        (b'content-disposition', disposition.encode('ascii')),
+                    ]})
+        disconnected = asyncio.ensure_future(wait_disconnect(receive))
+        offset = 0
+        try:
+            while not disconnected.done():
+                chunk = await shared.read(fd, offset)
+                if not chunk:
+                    break
+                offset += len(chunk)
+                await pace(paced, len(chunk))
+                await send({'type': 'http.response.body', 'body': chunk,
+                            'more_body': True})
+            if not disconnected.done():
+                await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnected.cancel()
+    finally:
+        paced.close()
+        fd.close()
+        shared.detach()
@@ -1,6 +1,8 @@
 from django.contrib import admin
 
-from .models import MediaFile, Directory, MediaFileLog, UserSettings
+from .models import (
+    MediaFile, Directory, MediaFileLog, UserSettings, EncoderDowngrade
+)
 
 
 class DirectoryAdmin(admin.ModelAdmin):
@@ -24,7 +26,15 @@ class MediaFileLogAdmin(admin.ModelAdmin):
         'request_params'
     )
 
+
+class EncoderDowngradeAdmin(admin.ModelAdmin):
+    list_display = (
+        'id', 'dtm', 'user', 'mediafile', 'segment', 'speed', 'fps',
+        'from_level', 'to_level'
+    )
+
 admin.site.register(MediaFile, MediaFileAdmin)
 admin.site.register(Directory, DirectoryAdmin)
 admin.site.register(MediaFileLog, MediaFileLogAdmin)
 admin.site.register(UserSettings)
+admin.site.register(EncoderDowngrade, EncoderDowngradeAdmin)
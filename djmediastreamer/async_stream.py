@@ -0,0 +1,58 @@
+"""Hands the transcode streams to the asyncio stream server (asgi_stream.py
+in the root of the project), so they don't hold a uwsgi worker each.
+
+The view decides what to stream (and checks the permissions) and redirects
+the player to settings.ASYNC_STREAM_URL with a signed token that has the
+parameters of the stream (never a command, the server builds it and
+checks them). The token expires after settings.ASYNC_STREAM_TOKEN_TTL
+seconds."""
+import hmac
+import json
+import time
+import base64
+import hashlib
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.http import urlencode
+
+
+def sign(payload, secret=None):
+    secret = secret or settings.ASYNC_STREAM_SECRET
+    if not secret:
+        raise ImproperlyConfigured(
+            'ASYNC_STREAM_SECRET must be set to use the stream server.')
+    return hmac.new(secret.encode('utf8'), payload,
+                    hashlib.sha256).hexdigest()
+
+
+def make_token(data, secret=None):
+    payload = base64.urlsafe_b64encode(json.dumps(data).encode('utf8'))
+    return '{p}.{s}'.format(p=payload.decode('ascii'),
+                            s=sign(payload, secret))
+
+
+def get_async_stream_url(params, mimetype, filename, download=False,
+                         cache_path=None, use_slot=False):
+    """Returns the url of the stream server that streams the output of the
+    ffmpeg command it builds from params: mode (transcode or remux), input,
+    goto, output_format and for transcodes width, height, vp8_crf, threads
+    and subtitles_filter, for remuxes audio_codec.
+
+    With cache_path a copy of the output is stored there when ffmpeg
+    finishes without errors. With use_slot the process takes one of the
+    transcode slots (see TranscodeScheduler)."""
+    data = {
+        'params': params,
+        'mimetype': mimetype,
+        'filename': filename,
+        'download': download,
+        'cache_path': cache_path,
+        'expires': int(time.time()) + settings.ASYNC_STREAM_TOKEN_TTL,
+    }
+    if use_slot:
+        data['slots_dir'] = settings.TRANSCODE_SLOTS_DIR
+        data['slots'] = settings.TRANSCODE_SLOTS
+        data['queue_timeout'] = settings.TRANSCODE_QUEUE_TIMEOUT
+    return settings.ASYNC_STREAM_URL + '?' + urlencode(
+        {'token': make_token(data)})
@@ -0,0 +1,239 @@
+import threading
+from collections import deque
+
+from django.conf import settings
+
+
+class SharedTranscode(object):
+    """The output of one transcode, read by one or more viewers.
+
+    A thread reads the output and keeps up to
+    settings.TRANSCODE_SHARED_BUFFER_SIZE bytes of it in a ring of chunks for
+    the viewers that are close to the end. A viewer that pauses doesn't stall
+    the others, the oldest chunks are dropped when the ring is full. When the
+    stream writes its output to a file (the temp_path of a CachingStream) the
+    viewers that fall behind the ring read that file and they can join at any
+    time, so the ring only keeps the chunks somebody has not read yet.
+    Otherwise the ring keeps the beginning of the output for the viewers that
+    join, the thread waits for the fastest viewer and a viewer that falls
+    behind the ring is ended. The stream is closed (and its process
+    terminated) when the last viewer detaches."""
+
+    def __init__(self, key, stream, broker):
+        self.key = key
+        self.stream = stream
+        self.broker = broker
+        self.buffer_size = settings.TRANSCODE_SHARED_BUFFER_SIZE
+        self.block_size = settings.STREAM_BLOCK_SIZE
+        self.chunks = deque()  # (offset, chunk)
+        self.start_offset = 0  # offset of the oldest chunk in the ring
+        self.end_offset = 0
+        self.offsets = {}  # SharedStream: offset it has read up to
+        self.done = False
+        self.closed = False
+        self.condition = threading.Condition()
+        temp_path = getattr(stream, 'temp_path', None)
+        self.spill = open(temp_path, 'rb') if temp_path else None
+        self.spill_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.pump)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def min_offset(self):
+        'The offset every viewer has read up to.'
+        if not self.offsets:
+            # keep the ring for the first viewer
+            return self.start_offset
+        return min(self.offsets.values())
+
+    def pump(self):
+        try:
+            for chunk in self.stream:
+                with self.condition:
+                    while self.must_wait():
+                        self.condition.wait()
+                    if self.closed:
+                        break
+                    self.chunks.append((self.end_offset, chunk))
+                    self.end_offset += len(chunk)
+                    self.drop_chunks()
+                    self.condition.notify_all()
+        finally:
+            with self.condition:
+                self.done = True
+                self.condition.notify_all()
+            self.stream.close()
+
+    def lead_offset(self):
+        'The offset the fastest viewer has read up to.'
+        if not self.offsets:
+            return self.start_offset
+        return max(self.offsets.values())
+
+    def must_wait(self):
+        'Without a file, the fastest viewer is waited for.'
+        return self.spill is None and not self.closed and \
+            self.end_offset - self.lead_offset() >= self.buffer_size
+
+    def can_drop(self, chunk_end, min_offset):
+        full = self.end_offset - self.start_offset > self.buffer_size
+        if chunk_end <= min_offset:
+            # everybody has read it
+            return full or self.spill is not None
+        return full and (self.spill is not None or
+                         chunk_end <= self.lead_offset())
+
+    def drop_chunks(self):
+        min_offset = self.min_offset()
+        while len(self.chunks) > 1:
+            chunk_offset, old = self.chunks[0]
+            if not self.can_drop(chunk_offset + len(old), min_offset):
+                break
+            self.chunks.popleft()
+            self.start_offset += len(old)
+
+    def can_attach(self):
+        with self.condition:
+            return not self.done and (
+                self.spill is not None or self.start_offset == 0)
+
+    def attach(self, reader):
+        with self.condition:
+            self.offsets[reader] = 0
+
+    def detach(self, reader):
+        'Returns the number of viewers left.'
+        with self.condition:
+            self.offsets.pop(reader, None)
+            self.condition.notify_all()
+            return len(self.offsets)
+
+    def stop(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.stream.close()
+        with self.spill_lock:
+            if self.spill is not None:
+                self.spill.close()
+
+    def read(self, reader, offset):
+        """Returns the data that starts at offset, waiting for it if it was
+        not produced yet. Returns None when the output is over or the reader
+        fell behind the ring and there is no file to read it from.
+
+        The reader has consumed everything before offset, those chunks can
+        be dropped."""
+        with self.condition:
+            if reader in self.offsets:
+                self.offsets[reader] = offset
+                self.condition.notify_all()
+            while offset >= self.end_offset and not self.done:
+                self.condition.wait()
+            if offset >= self.end_offset:
+                return None
+            if offset >= self.start_offset:
+                # readers are usually close to the end of the ring
+                for chunk_offset, chunk in reversed(self.chunks):
+                    if chunk_offset <= offset:
+                        return chunk[offset - chunk_offset:]
+            size = min(self.block_size, self.start_offset - offset)
+        return self.read_spill(offset, size)
+
+    def read_spill(self, offset, size):
+        'Reads data that is no longer in the ring from the output file.'
+        with self.spill_lock:
+            if self.spill is None or self.spill.closed:
+                return None
+            self.spill.seek(offset)
+            return self.spill.read(size) or None
+
+
+class SharedStream(object):
+    'A viewer of a SharedTranscode, to be used as a streaming response body.'
+
+    def __init__(self, shared):
+        self.shared = shared
+        self.offset = 0
+        self.closed = False
+
+    def __iter__(self):
+        while True:
+            chunk = self.shared.read(self, self.offset)
+            if chunk is None:
+                break
+            self.offset += len(chunk)
+            yield chunk
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.shared.broker.detach(self)
+
+
+class TranscodeBroker(object):
+    """Lets the viewers that request the same transcode share one ffmpeg
+    process (inside this process)."""
+
+    def __init__(self):
+        self.transcodes = {}
+        # key: Event set when the transcode that is being started is ready
+        self.starting = {}
+        self.lock = threading.Lock()
+
+    def attach(self, shared):
+        stream = SharedStream(shared)
+        shared.attach(stream)
+        return stream
+
+    def join(self, key):
+        'Returns a SharedStream or None if there is no transcode to join.'
+        with self.lock:
+            shared = self.transcodes.get(key)
+            if shared is None or not shared.can_attach():
+                return None
+            return self.attach(shared)
+
+    def get_stream(self, key, start_transcode):
+        """Returns a SharedStream of the transcode identified by key.
+
+        start_transcode is called when there is no transcode to join, it must
+        return the stream to share. It runs without holding the lock, the
+        viewers of the same key wait for it and the others don't."""
+        while True:
+            with self.lock:
+                shared = self.transcodes.get(key)
+                if shared is not None and shared.can_attach():
+                    return self.attach(shared)
+                starting = self.starting.get(key)
+                if starting is None:
+                    starting = self.starting[key] = threading.Event()
+                    break
+            # somebody else is starting it, join it when it is ready
+            starting.wait()
+        try:
+            shared = SharedTranscode(key, start_transcode(), self)
+        except Exception:
+            with self.lock:
+                del self.starting[key]
+            starting.set()
+            raise
+        with self.lock:
+            self.transcodes[key] = shared
+            stream = self.attach(shared)
+            del self.starting[key]
+        starting.set()
+        return stream
+
+    def detach(self, stream):
+        'Stops the transcode when its last viewer is gone.'
+        shared = stream.shared
+        with self.lock:
+            if shared.detach(stream) > 0:
+                return
+            if self.transcodes.get(shared.key) is shared:
+                del self.transcodes[shared.key]
+        shared.stop()
+
+
+transcode_broker = TranscodeBroker()
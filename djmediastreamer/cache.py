@@ -0,0 +1,113 @@
+import os
+import json
+import errno
+import time
+import hashlib
+import threading
+
+from django.conf import settings
+
+
+class TranscodeCache(object):
+    """Finished transcodes stored in settings.TRANSCODE_CACHE_DIR.
+
+    Entries are named after a hash of the transcode parameters. Their
+    modification time is updated on every hit and the least recently used
+    files are removed when the cache grows over
+    settings.TRANSCODE_CACHE_MAX_SIZE bytes. Files that are still being
+    written (.part and .tmp) are never removed."""
+
+    extensions = {'webm': 'webm', 'matroska': 'mkv', 'mp4': 'mp4'}
+    # don't walk the whole cache more than once every this seconds
+    eviction_interval = 60
+
+    def __init__(self, directory=None, max_size=None):
+        self.directory = directory or settings.TRANSCODE_CACHE_DIR
+        self.max_size = max_size or settings.TRANSCODE_CACHE_MAX_SIZE
+        self.last_eviction = 0
+
+    def get_key(self, mediafile, subtitles=None, goto=None,
+                output_format='webm', width=None, vp8_crf=None,
+                mode='transcode'):
+        params = [
+            mediafile.id, mediafile.size,
+            [s.id for s in subtitles or []],
+            goto, output_format, width, vp8_crf, mode
+        ]
+        return hashlib.sha1(json.dumps(params).encode('utf8')).hexdigest()
+
+    def get_path(self, key, output_format='webm'):
+        if not os.path.exists(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                pass
+        return os.path.join(self.directory, '{k}.{ext}'.format(
+            k=key, ext=self.extensions.get(output_format, output_format)))
+
+    def get_temp_path(self, path):
+        return '{p}.{pid}.{tid}.part'.format(
+            p=path, pid=os.getpid(), tid=threading.current_thread().ident)
+
+    def touch(self, path):
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    def get(self, key, output_format='webm'):
+        'Returns the path of the cached file or None if it is not cached.'
+        path = self.get_path(key, output_format)
+        if os.path.exists(path):
+            self.touch(path)
+            return path
+        return None
+
+    def put(self, temp_path, path):
+        """Moves a finished transcode into the cache. When the same
+        transcode was stored there first (by another worker or the stream
+        server) that one is kept."""
+        try:
+            os.link(temp_path, path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                self.discard(temp_path)
+                raise
+        os.remove(temp_path)
+        self.evict()
+
+    def discard(self, temp_path):
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    def evict(self, force=False):
+        'Removes the least recently used files until the quota is met.'
+        now = time.time()
+        if not force and now - self.last_eviction < self.eviction_interval:
+            return
+        self.last_eviction = now
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for f in files:
+                if f.endswith('.part') or f.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, f)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+
+transcode_cache = TranscodeCache()
@@ -0,0 +1,181 @@
+import os
+import json
+import shutil
+import functools
+import threading
+import subprocess
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+
+
+def split_ranges(keyframes, start, end, chunks):
+    """Returns the (start, duration) of about `chunks` parts of [start, end)
+    that begin at keyframes."""
+    length = max(float(end - start) / chunks, settings.CHUNK_MIN_DURATION)
+    cuts = [start]
+    for kf in keyframes:
+        if kf - cuts[-1] >= length and end - kf >= length / 2:
+            cuts.append(kf)
+    cuts.append(end)
+    return [(cuts[i], cuts[i + 1] - cuts[i]) for i in range(len(cuts) - 1)]
+
+
+class ChunkedTranscode(object):
+    """Encodes the parts of a file in parallel and joins them.
+
+    Every part goes to its own file in work_dir and progress.json records
+    which ones are done, so running it again after a crash only encodes the
+    missing parts. With separate_audio the parts only have video and the
+    audio is encoded once, over the whole range, and muxed when they are
+    joined (encoding it by parts leaves gaps at every cut)."""
+
+    def __init__(self, work_dir, ranges, extension='mkv',
+                 separate_audio=False):
+        self.work_dir = work_dir
+        self.extension = extension
+        self.lock = threading.Lock()
+        if not os.path.exists(work_dir):
+            os.makedirs(work_dir)
+        self.manifest_path = os.path.join(work_dir, 'progress.json')
+        self.audio_path = os.path.join(work_dir, 'audio.' + extension)
+        self.chunks = [
+            {'start': s, 'duration': d, 'done': False} for s, d in ranges
+        ]
+        self.audio = {'done': False} if separate_audio else None
+        manifest = self.load()
+        if manifest and [(c['start'], c['duration'])
+                         for c in manifest['chunks']] == \
+                [(c['start'], c['duration']) for c in self.chunks] and \
+                manifest.get('separate_audio', False) == separate_audio:
+            for i, m in enumerate(manifest['chunks']):
+                self.chunks[i]['done'] = m['done'] and os.path.exists(
+                    self.chunk_path(i))
+            if self.audio is not None:
+                self.audio['done'] = bool(manifest.get('audio')) and \
+                    os.path.exists(self.audio_path)
+        self.save()
+
+    def load(self):
+        if not os.path.exists(self.manifest_path):
+            return None
+        try:
+            with open(self.manifest_path) as fd:
+                manifest = json.load(fd)
+        except ValueError:
+            return None
+        return manifest if 'chunks' in manifest else None
+
+    def save(self):
+        temp_path = self.manifest_path + '.tmp'
+        with self.lock:
+            with open(temp_path, 'w') as fd:
+                json.dump({
+                    'chunks': self.chunks,
+                    'separate_audio': self.audio is not None,
+                    'audio': bool(self.audio and self.audio['done']),
+                }, fd)
+            os.rename(temp_path, self.manifest_path)
+
+    @property
+    def progress(self):
+        'Percentage of the duration already encoded.'
+        total = sum([c['duration'] for c in self.chunks])
+        done = sum([c['duration'] for c in self.chunks if c['done']])
+        return int(100.0 * done / total) if total else 0
+
+    def chunk_path(self, i):
+        return os.path.join(self.work_dir, '{i:05d}.{ext}'.format(
+            i=i, ext=self.extension))
+
+    def call(self, cmd):
+        """Runs an ffmpeg command with a transcode slot of the scheduler
+        given to run (if any) and returns its exit code."""
+        slot = self.scheduler.acquire_background() if self.scheduler \
+            else None
+        kwargs = slot.popen_kwargs() if slot else {}
+        with open(os.devnull, 'w') as devnull:
+            try:
+                process = subprocess.Popen(
+                    self.cmd_prefix + cmd, stdout=devnull, stderr=devnull,
+                    **kwargs)
+            finally:
+                if slot:
+                    # ffmpeg keeps its own copy of the slot
+                    slot.release()
+            return process.wait()
+
+    def encode(self, args):
+        'Encodes a chunk (or the audio) into path with get_cmd(output_file).'
+        entry, path, get_cmd = args
+        temp_path = path + '.tmp'
+        if self.call(get_cmd(temp_path)) != 0:
+            return False
+        os.rename(temp_path, path)
+        entry['done'] = True
+        self.save()
+        return True
+
+    def run(self, get_cmd, workers=None, on_progress=None,
+            get_audio_cmd=None, scheduler=None, cmd_prefix=None):
+        """Encodes the missing chunks. get_cmd(start, duration, output_file,
+        threads) returns the ffmpeg command of a chunk and, with
+        separate_audio, get_audio_cmd(output_file) the one of the audio.
+        on_progress(percent) is called from this thread every few seconds.
+
+        With a scheduler every ffmpeg waits for a transcode slot (see
+        TranscodeScheduler.acquire_background). cmd_prefix goes before the
+        commands, ie: ['nice', '-n', '19'].
+
+        Returns True when all of them are done."""
+        self.scheduler = scheduler
+        self.cmd_prefix = cmd_prefix or []
+        workers = workers or settings.CHUNKED_ENCODING_WORKERS or \
+            multiprocessing.cpu_count()
+        threads = max(1, multiprocessing.cpu_count() // workers)
+        pending = []
+        for i, c in enumerate(self.chunks):
+            if not c['done']:
+                pending.append((c, self.chunk_path(i), functools.partial(
+                    self.get_chunk_cmd, get_cmd, c, threads)))
+        if self.audio is not None and not self.audio['done']:
+            pending.append((self.audio, self.audio_path, get_audio_cmd))
+        if pending:
+            pool = ThreadPool(min(workers, len(pending)))
+            try:
+                result = pool.map_async(self.encode, pending)
+                while not result.ready():
+                    result.wait(5)
+                    if on_progress:
+                        on_progress(self.progress)
+            finally:
+                pool.close()
+                pool.join()
+        done = all([c['done'] for c in self.chunks])
+        return done and (self.audio is None or self.audio['done'])
+
+    def get_chunk_cmd(self, get_cmd, chunk, threads, output_file):
+        return get_cmd(chunk['start'], chunk['duration'], output_file,
+                       threads)
+
+    def concat(self, output_format, output_file):
+        'Joins the chunks (and the audio) without re-encoding them.'
+        list_path = os.path.join(self.work_dir, 'concat.txt')
+        with open(list_path, 'w') as fd:
+            for i in range(len(self.chunks)):
+                fd.write("file '{p}'\n".format(p=self.chunk_path(i)))
+        cmd = ['ffmpeg', '-f', 'concat', '-safe', '0', '-i', list_path]
+        if self.audio is not None:
+            cmd.extend([
+                '-i', self.audio_path, '-map', '0:v', '-map', '0:s?',
+                '-map', '1:a?'
+            ])
+        else:
+            cmd.extend(['-map', '0'])
+        cmd.extend(['-codec', 'copy', '-y', '-f', output_format, output_file])
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.call(cmd, stdout=devnull, stderr=devnull) == 0
+
+    def remove(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
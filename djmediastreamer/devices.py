@@ -0,0 +1,112 @@
+"""Device profiles: what every browser of a user said it can play.
+
+The watch page asks the player (HTMLMediaElement.canPlayType) about the
+types in PROBES and posts the answers. They are stored per user and device
+(a cookie) and used instead of guessing from the user agent."""
+import uuid
+
+from .models import DeviceProfile
+from .playback import get_client_capabilities
+
+DEVICE_COOKIE = 'device_id'
+# one year
+DEVICE_COOKIE_MAX_AGE = 365 * 24 * 3600
+
+# (container, kind, codec): type asked to the player
+PROBES = [
+    ('mp4', 'video', 'AVC', 'video/mp4; codecs="avc1.640028"'),
+    ('mp4', 'video', 'HEVC', 'video/mp4; codecs="hvc1.1.6.L93.B0"'),
+    ('mp4', 'audio', 'AAC', 'audio/mp4; codecs="mp4a.40.2"'),
+    ('mp4', 'audio', 'MPEGAudio', 'audio/mpeg'),
+    ('mp4', 'audio', 'AC-3', 'audio/mp4; codecs="ac-3"'),
+    ('mp4', 'audio', 'E-AC-3', 'audio/mp4; codecs="ec-3"'),
+    ('webm', 'video', 'VP8', 'video/webm; codecs="vp8"'),
+    ('webm', 'video', 'VP9', 'video/webm; codecs="vp9"'),
+    ('webm', 'audio', 'Vorbis', 'audio/webm; codecs="vorbis"'),
+    ('webm', 'audio', 'Opus', 'audio/webm; codecs="opus"'),
+    ('matroska', 'video', 'AVC', 'video/x-matroska; codecs="avc1.640028"'),
+    ('matroska', 'video', 'VP8', 'video/x-matroska; codecs="vp8"'),
+    ('matroska', 'video', 'VP9', 'video/x-matroska; codecs="vp9"'),
+    ('matroska', 'audio', 'AAC', 'video/x-matroska; codecs="mp4a.40.2"'),
+    ('matroska', 'audio', 'Vorbis', 'video/x-matroska; codecs="vorbis"'),
+    ('matroska', 'audio', 'Opus', 'video/x-matroska; codecs="opus"'),
+]
+
+
+def get_probe_types():
+    return [p[3] for p in PROBES]
+
+
+def capabilities_from_probes(results):
+    """Returns the capabilities (as lists, to be stored in json) from the
+    canPlayType answers, a dict of type: '' | 'maybe' | 'probably'.
+
+    A container is only included if the player can play some video in it."""
+    res = {}
+    for container, kind, codec, mimetype in PROBES:
+        if results.get(mimetype) in ('maybe', 'probably'):
+            codecs = res.setdefault(container, {'video': [], 'audio': []})
+            codecs[kind].append(codec)
+    return dict([(c, v) for c, v in res.items() if v['video']])
+
+
+def get_device_id(request):
+    return request.COOKIES.get(DEVICE_COOKIE)
+
+
+def set_device_cookie(request, response):
+    'Gives the browser a device id if it still has none.'
+    if not get_device_id(request):
+        response.set_cookie(DEVICE_COOKIE, uuid.uuid4().hex,
+                            max_age=DEVICE_COOKIE_MAX_AGE, httponly=True)
+    return response
+
+
+def get_device_profile(request):
+    device_id = get_device_id(request)
+    if not device_id or not request.user.is_authenticated():
+        return None
+    return DeviceProfile.objects.filter(
+        user=request.user, device_id=device_id).first()
+
+
+def save_device_profile(request, results):
+    """Stores the capabilities of the device of the request. Returns the
+    DeviceProfile or None if the request has no device id."""
+    device_id = get_device_id(request)
+    if not device_id:
+        return None
+    profile, _ = DeviceProfile.objects.update_or_create(
+        user=request.user, device_id=device_id,
+        defaults={
+            'user_agent': request.META.get('HTTP_USER_AGENT', ''),
+            'capabilities': capabilities_from_probes(results),
+        }
+    )
+    return profile
+
+
+def needs_probe(request, profile=None):
+    'Whether the player has to report its capabilities.'
+    profile = profile or get_device_profile(request)
+    return profile is None or \
+        profile.user_agent != request.META.get('HTTP_USER_AGENT', '')
+
+
+def get_capabilities(request, profile=None):
+    """Returns the capabilities of the device profile, or the ones guessed
+    from the user agent when the device didn't report them yet."""
+    profile = profile or get_device_profile(request)
+    guessed = get_client_capabilities(request)
+    if profile is None:
+        return guessed
+    res = {}
+    for container, codecs in profile.capabilities.items():
+        res[container] = {
+            'video': set(codecs['video']), 'audio': set(codecs['audio'])
+        }
+    # browsers play matroska through their webm support but most of them
+    # answer '' when they are asked about it
+    if 'matroska' not in res and 'matroska' in guessed:
+        res['matroska'] = guessed['matroska']
+    return res
@@ -0,0 +1,159 @@
+"""Sends files with support for byte ranges and conditional requests.
+
+With an offloading sendfile backend (nginx, xsendfile, mod_wsgi) the web
+server does all of that, so the file is just handed to it. Otherwise the
+file is read here: Range (one range), If-Range, If-None-Match and
+If-Modified-Since are honoured and every response has an ETag and a
+Last-Modified header, so a seek in the player only reads from where it
+goes."""
+import os
+import re
+import mimetypes
+import unicodedata
+
+from sendfile import sendfile
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.encoding import force_text
+from django.utils.http import http_date, parse_http_date_safe, urlquote
+
+from .streaming import FileStream
+from .pacing import BULK, PacedStream, stream_pacer
+
+OFFLOAD_BACKENDS = (
+    'sendfile.backends.nginx',
+    'sendfile.backends.xsendfile',
+    'sendfile.backends.mod_wsgi',
+)
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def get_etag(st):
+    return '"{s:x}-{m:x}"'.format(s=st.st_size, m=int(st.st_mtime))
+
+
+def parse_range(header, size):
+    """Returns the (start, end) (end included) of a Range header, None if
+    there is no usable range (the whole file is sent) or False if it can't
+    be satisfied. Only one range is supported."""
+    match = RANGE_RE.match(header.replace(' ', ''))
+    if not match:
+        return None
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start:
+        # the last bytes
+        length = int(end)
+        if length == 0 or size == 0:
+            return False
+        return max(size - length, 0), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def get_content_disposition(filename, attachment=True):
+    """Returns a Content-Disposition header like sendfile does: an ASCII
+    filename and the UTF-8 one (RFC 5987) when they are not the same."""
+    filename = force_text(filename)
+    ascii_filename = unicodedata.normalize('NFKD', filename).encode(
+        'ascii', 'ignore').decode('ascii')
+    parts = ['attachment'] if attachment else []
+    parts.append('filename="{fn}"'.format(
+        fn=ascii_filename.replace('\\', '\\\\').replace('"', '\\"')))
+    if ascii_filename != filename:
+        parts.append("filename*=UTF-8''{fn}".format(fn=urlquote(filename)))
+    return '; '.join(parts)
+
+
+def etag_matches(header, etag):
+    'Weak comparison against an If-None-Match header.'
+    if header.strip() == '*':
+        return True
+    tags = [t.strip() for t in header.split(',')]
+    return etag in [t[2:] if t.startswith('W/') else t for t in tags]
+
+
+def not_modified(request, etag, mtime):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+    since = parse_http_date_safe(
+        request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return since is not None and int(mtime) <= since
+
+
+def range_applies(request, etag, mtime):
+    'Whether the If-Range header (if any) still matches the file.'
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith('"'):
+        return if_range == etag
+    date = parse_http_date_safe(if_range)
+    return date is not None and int(mtime) <= date
+
+
+def serve_file(request, path, mimetype=None, attachment=False,
+               attachment_filename=None, kind=None, rate=None, burst=None):
+    """Returns a response with the file.
+
+    With kind (pacing.LIVE or pacing.BULK) the file is paced at rate bytes
+    per second after burst bytes, see pacing.PacedStream."""
+    mimetype = mimetype or mimetypes.guess_type(path)[0] or \
+        'application/octet-stream'
+    if settings.SENDFILE_BACKEND in OFFLOAD_BACKENDS:
+        res = sendfile(request, path, attachment=attachment,
+                       attachment_filename=attachment_filename,
+                       mimetype=mimetype)
+        if kind == BULK and settings.SENDFILE_BACKEND == \
+                'sendfile.backends.nginx':
+            # nginx sends it at the share of the bandwidth there is now
+            rates = [r for r in (rate, stream_pacer.get_bulk_rate()) if r]
+            if rates:
+                res['X-Accel-Limit-Rate'] = str(min(rates))
+        return res
+    st = os.stat(path)
+    etag = get_etag(st)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(st.st_mtime),
+        'Accept-Ranges': 'bytes',
+    }
+    if request.method in ('GET', 'HEAD') and \
+            not_modified(request, etag, st.st_mtime):
+        res = HttpResponse(status=304)
+        for k, v in headers.items():
+            res[k] = v
+        return res
+    size = st.st_size
+    byte_range = None
+    if 'HTTP_RANGE' in request.META and \
+            range_applies(request, etag, st.st_mtime):
+        byte_range = parse_range(request.META['HTTP_RANGE'], size)
+    if byte_range is False:
+        res = HttpResponse(status=416)
+        res['Content-Range'] = 'bytes */{s}'.format(s=size)
+        return res
+    start, end = byte_range or (0, size - 1)
+    fd = open(path, 'rb')
+    fd.seek(start)
+    stream = FileStream(fd, length=end - start + 1)
+    if kind:
+        stream = PacedStream(stream, rate, burst, kind)
+    res = StreamingHttpResponse(stream, content_type=mimetype)
+    if byte_range:
+        res.status_code = 206
+        res['Content-Range'] = 'bytes {s}-{e}/{t}'.format(
+            s=start, e=end, t=size)
+    res['Content-Length'] = str(end - start + 1)
+    for k, v in headers.items():
+        res[k] = v
+    if attachment:
+        res['Content-Disposition'] = get_content_disposition(
+            attachment_filename or os.path.basename(path))
+    return res
@@ -0,0 +1,165 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils.http import urlencode
+
+
+def get_segments_key(mediafile, subtitles=None, width=None, height=None,
+                     crf=None, level=0):
+    """Returns a hash that identifies the segments of a mediafile transcoded
+    with the given parameters and encoder level."""
+    params = [
+        mediafile.id, mediafile.size,
+        [s.id for s in subtitles or []],
+        width, height, crf
+    ]
+    if level:
+        params.append(level)
+    return hashlib.sha1(json.dumps(params).encode('utf8')).hexdigest()
+
+
+def get_encoder_params(level, mediafile, width=None, height=None):
+    """Returns the (preset, width, height) of one of the
+    settings.ENCODER_LEVELS."""
+    levels = settings.ENCODER_LEVELS
+    level = levels[min(level, len(levels) - 1)]
+    full_width = width or mediafile.width
+    full_height = height or mediafile.height
+    if level['scale'] < 1 and full_width and full_height:
+        # libx264 needs even dimensions
+        width = int(full_width * level['scale']) // 2 * 2
+        height = int(full_height * level['scale']) // 2 * 2
+    return level['preset'], width, height
+
+
+def get_rendition(name, mediafile=None, max_width=None):
+    """Returns the rendition with that name. With a mediafile only the ones
+    of its master playlist (see get_renditions) are found."""
+    renditions = get_renditions(mediafile, max_width) if mediafile \
+        else settings.RENDITIONS
+    for rendition in renditions:
+        if rendition['name'] == name:
+            return rendition
+    return None
+
+
+def get_renditions(mediafile, max_width=None):
+    """Returns the renditions that make sense for a mediafile, the largest
+    first. A file smaller than all of them gets the smallest one."""
+    renditions = sorted(settings.RENDITIONS, key=lambda r: -r['width'])
+    if not renditions:
+        return []
+    max_width = min([w for w in (mediafile.width, max_width) if w] or [None])
+    res = [r for r in renditions if not max_width or r['width'] <= max_width]
+    return res or renditions[-1:]
+
+
+def get_rendition_size(mediafile, rendition):
+    """Returns the (width, height) of a rendition of a mediafile, never
+    larger than the file."""
+    if not mediafile.width or not mediafile.height:
+        return None, None
+    width = min(rendition['width'], mediafile.width) // 2 * 2
+    height = int(mediafile.height * width / mediafile.width) // 2 * 2
+    return width, height
+
+
+def get_query_string(request, subtitles=True):
+    'Returns the (escaped) query string with the selected subtitles.'
+    params = [(k, v) for k, v in sorted(request.GET.items())
+              if subtitles and k.startswith('sub_')]
+    if params:
+        return '?' + urlencode(params)
+    return ''
+
+
+def get_segments_count(mediafile):
+    duration = settings.SEGMENT_DURATION
+    return int((mediafile.duration + duration - 1) / duration)
+
+
+def get_segment_times(mediafile, number):
+    'Returns the (start, duration) in seconds of the given segment.'
+    start = number * settings.SEGMENT_DURATION
+    duration = min(settings.SEGMENT_DURATION, mediafile.duration - start)
+    return start, duration
+
+
+def get_segment_path(key, number, create=True):
+    directory = os.path.join(settings.SEGMENTS_DIR, key)
+    if create and not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # created by another request in the meantime
+            pass
+    return os.path.join(directory, '{n:05d}.ts'.format(n=number))
+
+
+# (full path, subtitles ids): the filter that burns them in the segments
+subtitles_filters = OrderedDict()
+subtitles_filters_lock = threading.Lock()
+SUBTITLES_FILTERS_MAX = 100
+
+
+def get_subtitles_filter(full_path, subtitles, prepare):
+    """Returns the ffmpeg filter that burns the subtitles in the segments of
+    a file. prepare(full_path, subtitles) prepares the subtitles file and
+    returns the filter, it is only called for the first segment (or when
+    the prepared file was removed from the store) instead of for every
+    one."""
+    if not subtitles:
+        return None
+    key = (full_path, tuple([s.id for s in subtitles]))
+    with subtitles_filters_lock:
+        subtitles_filter = subtitles_filters.get(key)
+    if subtitles_filter and \
+            os.path.exists(subtitles_filter.split('=', 1)[1]):
+        return subtitles_filter
+    subtitles_filter = prepare(full_path, subtitles)
+    with subtitles_filters_lock:
+        subtitles_filters[key] = subtitles_filter
+        while len(subtitles_filters) > SUBTITLES_FILTERS_MAX:
+            subtitles_filters.popitem(last=False)
+    return subtitles_filter
+
+
+def render_master_playlist(mediafile, renditions, playlist_url):
+    """Returns a master playlist with a variant per rendition.
+
+    playlist_url is a function that receives the rendition name and returns
+    the url of its playlist."""
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3']
+    for rendition in renditions:
+        width, height = get_rendition_size(mediafile, rendition)
+        stream_inf = '#EXT-X-STREAM-INF:BANDWIDTH={b}'.format(
+            b=rendition['bandwidth'])
+        if width:
+            stream_inf += ',RESOLUTION={w}x{h}'.format(w=width, h=height)
+        lines.append(stream_inf)
+        lines.append(playlist_url(rendition['name']))
+    return '\n'.join(lines) + '\n'
+
+
+def render_playlist(mediafile, segment_url):
+    """Returns a VOD playlist with fixed duration segments.
+
+    segment_url is a function that receives the segment number and returns
+    its url."""
+    lines = [
+        '#EXTM3U',
+        '#EXT-X-VERSION:3',
+        '#EXT-X-TARGETDURATION:{d}'.format(d=settings.SEGMENT_DURATION),
+        '#EXT-X-MEDIA-SEQUENCE:0',
+        '#EXT-X-PLAYLIST-TYPE:VOD',
+    ]
+    for n in range(get_segments_count(mediafile)):
+        _, duration = get_segment_times(mediafile, n)
+        lines.append('#EXTINF:{d:.3f},'.format(d=duration))
+        lines.append(segment_url(n))
+    lines.append('#EXT-X-ENDLIST')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,95 @@
+"""Batched MediaFile writes for collect_media."""
+import json
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from .models import MediaFile
+
+COLUMNS = [
+    'directory', 'file_name', 'extension', 'size', 'width', 'height',
+    'v_codec', 'a_codec', 'duration', 'props'
+]
+
+
+def load_existing(directory=None):
+    """Returns the {directory: {file_name: size}} of the MediaFiles in a
+    tree (all of them without directory), in one query."""
+    qs = MediaFile.objects.all()
+    if directory:
+        qs = qs.filter(directory__startswith=directory.rstrip('/'))
+    res = {}
+    for d, f, s in qs.values_list('directory', 'file_name', 'size'):
+        res.setdefault(d, {})[f] = s
+    return res
+
+
+def load_without_keyframes(directory=None):
+    'Returns the (directory, file_name) of the MediaFiles without keyframes.'
+    qs = MediaFile.objects.exclude(props__has_key='keyframes')
+    if directory:
+        qs = qs.filter(directory__startswith=directory.rstrip('/'))
+    return set(qs.values_list('directory', 'file_name'))
+
+
+class MediaFileWriter(object):
+    """Inserts MediaFiles in batches of settings.COLLECT_MEDIA_BATCH_SIZE
+    rows, each batch is one INSERT ... ON CONFLICT in its own transaction.
+
+    A row whose directory and file name already exist updates the given
+    columns. props is replaced, not merged: the rows are new or changed
+    files, what was stored about the old file (ie: its keyframes) is
+    stale."""
+
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size or settings.COLLECT_MEDIA_BATCH_SIZE
+        self.rows = {}
+        self.count = 0
+
+    def add(self, directory, file_name, **values):
+        values['directory'] = directory
+        values['file_name'] = file_name
+        # the same row twice in one statement is an error, the last wins
+        self.rows[(directory, file_name)] = values
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def get_sql(self, columns, n):
+        placeholders = ', '.join(
+            ['%s::jsonb' if c == 'props' else '%s' for c in columns])
+        updates = []
+        for c in columns:
+            if c in ('directory', 'file_name'):
+                continue
+            updates.append('{c} = EXCLUDED.{c}'.format(c=c))
+        sql = 'INSERT INTO {t} AS t ({c}) VALUES {v} ' \
+            'ON CONFLICT (directory, file_name) '.format(
+                t=MediaFile._meta.db_table, c=', '.join(columns),
+                v=', '.join(['({p})'.format(p=placeholders)] * n))
+        if updates:
+            sql += 'DO UPDATE SET ' + ', '.join(updates)
+        else:
+            sql += 'DO NOTHING'
+        return sql
+
+    def flush(self):
+        if not self.rows:
+            return
+        # rows with different columns go in different statements
+        groups = {}
+        for values in self.rows.values():
+            columns = tuple([c for c in COLUMNS if c in values])
+            groups.setdefault(columns, []).append(values)
+        with transaction.atomic():
+            cursor = connection.cursor()
+            for columns, rows in groups.items():
+                params = []
+                for values in rows:
+                    for c in columns:
+                        v = values[c]
+                        if c == 'props' and v is not None:
+                            v = json.dumps(v)
+                        params.append(v)
+                cursor.execute(self.get_sql(columns, len(rows)), params)
+        self.count += len(self.rows)
+        self.rows = {}
@@ -0,0 +1,125 @@
+"""Background transcode jobs.
+
+Every job has a key (a hash of its parameters), so submitting one that is
+already queued or running returns the existing job instead of queueing
+another. The tasks run with the priority of their kind (see
+settings.TRANSCODE_JOB_PRIORITIES) and report their progress in the
+TranscodeJob. A task that raises marks its job failed with the error."""
+import json
+import hashlib
+import datetime
+import functools
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.utils import timezone
+
+from .models import TranscodeJob
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+GENERATE = 'generate'  # generate file, offline
+PREWARM = 'prewarm'  # the next file of what is being watched
+
+
+def get_job_key(kind, params):
+    return hashlib.sha1(
+        json.dumps([kind, params]).encode('utf8')).hexdigest()
+
+
+def is_active(job):
+    'Whether the job is queued or running (and still reporting progress).'
+    if job.status == QUEUED:
+        return True
+    if job.status == RUNNING:
+        stale = timezone.now() - datetime.timedelta(
+            seconds=settings.TRANSCODE_JOB_STALE_AFTER)
+        return job.dtm > stale
+    return False
+
+
+def submit(task, kind, params, mediafile, user, **kwargs):
+    """Queues task(job_id=..., **kwargs) unless an identical job is active.
+
+    params identifies the job. Returns the TranscodeJob."""
+    key = get_job_key(kind, params)
+    try:
+        job, queued = queue_job(key, kind, mediafile, user)
+    except IntegrityError:
+        # created by a concurrent submit
+        job, queued = queue_job(key, kind, mediafile, user)
+    if queued:
+        task(job_id=job.id, priority=job.priority, **kwargs)
+    return job
+
+
+def queue_job(key, kind, mediafile, user):
+    """Returns the (TranscodeJob, queued), queued is False when the job was
+    already active."""
+    with transaction.atomic():
+        job, created = TranscodeJob.objects.select_for_update().get_or_create(
+            key=key, defaults={
+                'kind': kind, 'mediafile': mediafile, 'user': user,
+                'priority': settings.TRANSCODE_JOB_PRIORITIES[kind],
+            })
+        if not created:
+            if is_active(job):
+                return job, False
+            job.status = QUEUED
+            job.progress = 0
+            job.error = None
+            job.user = user
+            job.save()
+    return job, True
+
+
+def reports_failure(task):
+    """Decorates a task that takes a job_id: when it raises, its job is set
+    to FAILED with the error (instead of staying RUNNING until it is stale)
+    and the exception goes on."""
+    @functools.wraps(task)
+    def wrapper(*args, **kwargs):
+        try:
+            return task(*args, **kwargs)
+        except Exception as e:
+            JobProgress(kwargs.get('job_id')).fail(e)
+            raise
+    return wrapper
+
+
+class JobProgress(object):
+    'Updates the TranscodeJob of a task, if it has one.'
+
+    def __init__(self, job_id=None):
+        self.job = TranscodeJob.objects.filter(id=job_id).first() \
+            if job_id else None
+
+    def set(self, status=None, progress=None, error=None):
+        if self.job is None:
+            return
+        if status:
+            self.job.status = status
+        if progress is not None:
+            self.job.progress = max(0, min(100, int(progress)))
+        if error is not None:
+            self.job.error = error
+        self.job.save(update_fields=['status', 'progress', 'error', 'dtm'])
+
+    def start(self):
+        self.set(RUNNING, 0)
+
+    def update(self, progress):
+        self.set(progress=progress)
+
+    def finish(self, ok=True):
+        if ok:
+            self.set(DONE, 100)
+        else:
+            self.set(FAILED)
+
+    def fail(self, error):
+        self.set(FAILED, error='{t}: {e}'.format(
+            t=type(error).__name__, e=error))
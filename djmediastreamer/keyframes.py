@@ -0,0 +1,86 @@
+import zlib
+import base64
+import bisect
+import subprocess
+from array import array
+
+from .utils import format_time, str_duration_to_seconds, with_timeout
+
+
+def probe_keyframes(full_path, timeout=None):
+    'Returns the times (in seconds) of the keyframes of the first video.'
+    output = subprocess.check_output(with_timeout([
+        'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+        '-show_entries', 'packet=pts_time,flags', '-of', 'csv=print_section=0',
+        full_path
+    ], timeout))
+    res = []
+    for line in output.splitlines():
+        split = line.split(',')
+        if len(split) > 1 and 'K' in split[1] and split[0] not in ('', 'N/A'):
+            res.append(float(split[0]))
+    return sorted(res)
+
+
+def pack(times):
+    """Returns the keyframe times as a short string: the differences in
+    milliseconds between consecutive keyframes in an array of unsigned ints,
+    compressed and base64 encoded."""
+    deltas = array('I')
+    last = 0
+    for t in times:
+        ms = max(int(round(t * 1000)), last)
+        deltas.append(ms - last)
+        last = ms
+    data = deltas.tobytes() if hasattr(deltas, 'tobytes') \
+        else deltas.tostring()
+    return base64.b64encode(zlib.compress(data)).decode('ascii')
+
+
+def unpack(packed):
+    deltas = array('I')
+    data = zlib.decompress(base64.b64decode(packed))
+    if hasattr(deltas, 'frombytes'):
+        deltas.frombytes(data)
+    else:
+        deltas.fromstring(data)
+    res = []
+    ms = 0
+    for d in deltas:
+        ms += d
+        res.append(ms / 1000.0)
+    return res
+
+
+def get_keyframes(mediafile):
+    'Returns the stored keyframe times or None if there is no index.'
+    packed = (mediafile.props or {}).get('keyframes')
+    return unpack(packed) if packed else None
+
+
+def build_keyframe_index(mediafile, save=True):
+    'Probes the keyframes of a mediafile and stores them in its props.'
+    keyframes = probe_keyframes(mediafile.full_path)
+    props = mediafile.props or {}
+    props['keyframes'] = pack(keyframes)
+    mediafile.props = props
+    if save and mediafile.pk:
+        mediafile.save(update_fields=['props'])
+    return keyframes
+
+
+def snap(keyframes, seconds):
+    'Returns the time of the last keyframe at or before seconds.'
+    i = bisect.bisect_right(keyframes, seconds + 0.0005)
+    return keyframes[i - 1] if i else 0
+
+
+def snap_goto(mediafile, goto):
+    """Moves a goto (HH:MM:SS or N%) back to the previous keyframe, which is
+    where ffmpeg really starts. Returns it unchanged when the mediafile has no
+    keyframe index."""
+    keyframes = get_keyframes(mediafile)
+    if not goto or not keyframes:
+        return goto
+    return format_time(snap(keyframes, str_duration_to_seconds(
+        goto, mediafile)))
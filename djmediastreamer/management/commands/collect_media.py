@@ -2,12 +2,40 @@
 
 import os
 import sys
+import subprocess
+import multiprocessing
 
+from django.db import connections
 from django.conf import settings
 from django.core.management.base import BaseCommand
 
-from djmediastreamer.utils import MediaInfo
+from djmediastreamer.keyframes import (
+    build_keyframe_index, probe_keyframes, pack
+)
 from djmediastreamer.models import MediaFile, Directory
+from djmediastreamer.probe import has_json_output, probe_media
+from djmediastreamer.scanning import (IgnoreTrie, get_extension_set,
+                                      has_extension)
+from djmediastreamer.snapshots import SnapshotWalker
+from djmediastreamer.ingest import (
+    MediaFileWriter, load_existing, load_without_keyframes
+)
+
+
+def probe_file(args):
+    """Runs mediainfo (and ffprobe for the keyframes) on a new file, in a
+    worker of the pool. Returns (path, fields, error)."""
+    path, with_mediainfo, json_output, with_keyframes, timeout = args
+    fields = {}
+    try:
+        if with_mediainfo:
+            fields.update(probe_media(path, timeout, json_output))
+        if with_keyframes:
+            fields.setdefault('props', {})['keyframes'] = pack(
+                probe_keyframes(path, timeout))
+    except (subprocess.CalledProcessError, OSError, ValueError) as e:
+        return path, None, str(e)
+    return path, fields, None
 
 
 class Command(BaseCommand):
@@ -19,6 +47,13 @@ class Command(BaseCommand):
             default=False,
             help='Collect Mediainfo data.',
         )
+        parser.add_argument(
+            '--with-keyframes',
+            action='store_true',
+            dest='with_keyframes',
+            default=False,
+            help='Build the keyframes index (reads the whole file).',
+        )
         parser.add_argument(
             '--with-md5',
             action='store_true',
@@ -39,75 +74,179 @@ class Command(BaseCommand):
             default=False,
             help='Removes MediaFiles from the DB associated with files that no longer exists in the selected directory.',  # noqa
         )
+        parser.add_argument(
+            '--jobs',
+            dest='jobs',
+            type=int,
+            default=1,
+            help='Number of files probed at the same time (0 means one per core).',  # noqa
+        )
+        parser.add_argument(
+            '--timeout',
+            dest='timeout',
+            type=int,
+            default=settings.COLLECT_MEDIA_TIMEOUT,
+            help='Seconds a file can be probed before giving up on it.',
+        )
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            dest='full',
+            default=False,
+            help='List every directory, even the ones that did not change since the last scan.',  # noqa
+        )
         parser.add_argument(
             '--limit',
             dest='limit',
-            default=1000,
-            help='Max number of files to collect.',  # noqa
+            type=int,
+            default=None,
+            help='Max number of files to collect (no limit by default).',  # noqa
         )
 
+    def probe_new_files(self, new_files, options):
+        """Probes the new (or changed) files in a pool of --jobs processes
+        and writes them here in batches, as the results arrive.
+
+        new_files is {path: size}. Returns the paths that couldn't be
+        probed."""
+        jobs = options.get('jobs')
+        if jobs is None:
+            jobs = 1
+        jobs = jobs or multiprocessing.cpu_count()
+        # checked here once, not in every worker
+        json_output = bool(new_files) and \
+            bool(options.get('with_mediainfo')) and has_json_output()
+        tasks = [
+            (f, options.get('with_mediainfo'), json_output,
+             options.get('with_keyframes'), options.get('timeout'))
+            for f in new_files
+        ]
+        pool = None
+        probe = options.get('with_mediainfo') or options.get('with_keyframes')
+        if probe and jobs > 1 and len(tasks) > 1:
+            # the workers don't use the db, don't share the connection
+            connections.close_all()
+            pool = multiprocessing.Pool(jobs)
+            results = pool.imap_unordered(probe_file, tasks)
+        else:
+            results = (probe_file(t) for t in tasks)
+        writer = MediaFileWriter()
+        failed = []
+        try:
+            for f, fields, error in results:
+                if error:
+                    self.stderr.write('Skipping {f}: {e}'.format(f=f, e=error))
+                    failed.append(f)
+                    continue
+                n = os.path.basename(f)
+                # the props of a changed file are replaced, even if this
+                # run didn't probe anything
+                fields.setdefault('props', None)
+                writer.add(os.path.dirname(f), n,
+                           extension=n.split('.')[-1].lower(),
+                           size=new_files[f], **fields)
+            writer.flush()
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        return failed
+
+    def build_missing_keyframes(self, path, name, without_keyframes):
+        if (path, name) in without_keyframes:
+            build_keyframe_index(
+                MediaFile.objects.get(directory=path, file_name=name))
+
+    def collect_directory(self, directory, ignore_paths, options):
+        """Collects the videos of a tree, only listing the directories that
+        changed since the last run (see snapshots.SnapshotWalker)."""
+        limit = int(options.get('limit') or 0)
+        walker = SnapshotWalker(settings.VIDEO_EXTENSIONS, ignore_paths,
+                                options.get('full'))
+        new_files = {}
+        # loaded with the first directory that changed
+        existing = None
+        without_keyframes = set()
+        finished = True
+        for path, files, old_files in walker.walk(directory):
+            if existing is None:
+                existing = load_existing(directory)
+                if options.get('with_keyframes'):
+                    without_keyframes = load_without_keyframes(directory)
+            rows = existing.get(path, {})
+            for name, signature in files.items():
+                size = rows.get(name, -1)
+                old = old_files.get(name)
+                if size == -1 or (old and old != signature) or \
+                        (not old and size != signature[1]):
+                    # new or changed since the last scan
+                    new_files[os.path.join(path, name)] = signature[1]
+                elif options.get('with_keyframes'):
+                    self.build_missing_keyframes(path, name,
+                                                 without_keyframes)
+            if options.get('remove_missing'):
+                missing = [n for n in rows if n not in files]
+                if missing:
+                    MediaFile.objects.filter(
+                        directory=path, file_name__in=missing).delete()
+            if limit and len(new_files) >= limit:
+                finished = False
+                break
+        if finished and options.get('remove_missing'):
+            if walker.removed:
+                MediaFile.objects.filter(
+                    directory__in=walker.removed).delete()
+            if walker.first_scan or options.get('full'):
+                # rows collected before there were snapshots
+                others = MediaFile.objects.filter(
+                    directory__startswith=directory
+                ).exclude(directory__in=list(walker.seen))
+                for mf in others:
+                    if not os.path.exists(mf.full_path):
+                        mf.delete()
+        for f in self.probe_new_files(new_files, options):
+            walker.forget(os.path.dirname(f))
+        walker.save()
+
     def handle(self, *args, **options):
         count = 0
+        # path: size of the files that are not in the db yet
+        new_files = {}
         ignore_directories = Directory.objects.filter(ignore=True)
-        lines = sys.stdin
-        directory = str(options.get('directory'))
+        directory = options.get('directory')
         limit = options.get('limit')
         if directory:
-            lines = []
-            walk = os.walk(directory)
-            for t in walk:
-                d = t[0]
-                for f in t[2]:
-                    #  TODO: just add the video files.
-                    lines.append(os.path.join(t[0], f))
+            if not os.path.exists(directory):
+                print 'Skiping because the directory does not exists.'
+                return
+            self.collect_directory(
+                directory, [str(d.path) for d in ignore_directories], options)
+            return
 
-        for line in lines:
-            ignore = False
+        existing = load_existing()
+        without_keyframes = load_without_keyframes() \
+            if options.get('with_keyframes') else set()
+        ignore = IgnoreTrie([str(d.path) for d in ignore_directories])
+        extensions = get_extension_set(settings.VIDEO_EXTENSIONS)
+        for line in sys.stdin:
             f = line.strip()
-            l = f.lower()
-            for d in ignore_directories:
-                if f.startswith(str(d.path)):
-                    ignore = True
-            if ignore:
+            if f in ignore or not has_extension(f, extensions):
                 continue
-            for e in settings.VIDEO_EXTENSIONS:
-                if l.endswith('.' + e):
-                    count += 1
-                    split = f.split('/')
-                    n = split[-1]
-                    path = '/'.join(split[:-1])
-                    ext = n.split('.')[-1].lower()
-                    s = os.path.getsize(f)
-                    mf = MediaFile.objects.filter(file_name=n, directory=path)
-                    if mf:
-                        mf = mf.first()
-                        found = True
-                    else:
-                        mf = MediaFile(
-                            file_name=n,
-                            directory=path,
-                            extension=ext,
-                            size=s,
-                        )
-                        if options.get('with_mediainfo'):
-                            mi = MediaInfo(f)
-                            mf.width, mf.height = mi.get_size()
-                            mf.v_codec = mi.get_video_codec()
-                            mf.a_codec = mi.get_audio_codec()
-                            mf.duration = mi.get_duration()
-                        found = False
-                        mf.save()
-                    break
+            count += 1
+            split = f.split('/')
+            n = split[-1]
+            path = '/'.join(split[:-1])
+            if n in existing.get(path, {}):
+                if options.get('with_keyframes'):
+                    self.build_missing_keyframes(path, n, without_keyframes)
+            else:
+                new_files[f] = os.path.getsize(f)
             if count == limit:
                 break
 
+        self.probe_new_files(new_files, options)
+
         if options.get('remove_missing'):
-            mediafiles = MediaFile.objects.all()
-            if directory:
-                if not os.path.exists(directory):
-                    print 'Skiping because the directory does not exists.'
-                    return
-                mediafiles = mediafiles.filter(directory__startswith=directory)
-            for mf in mediafiles:
+            for mf in MediaFile.objects.all():
                 if not os.path.exists(mf.full_path):
                     mf.delete()
@@ -12,6 +12,8 @@ from django.contrib.postgres.search import SearchVector
 
 from djmediastreamer.models import (MediaFile, Directory, SubtitlesFile,
                                     SubtitlesLine)
+from djmediastreamer.scanning import (IgnoreTrie, get_extension_set,
+                                      walk_files)
 
 
 class Command(BaseCommand):
@@ -141,20 +143,10 @@ class Command(BaseCommand):
         limit = options.get('directory')
         ignore_directories = Directory.objects.filter(ignore=True)
         directory = str(options.get('directory'))
-        walk = os.walk(directory)
-        for t in walk:
-            ignore = False
-            d = t[0]
-            for ign_dir in ignore_directories:
-                if d.startswith(str(ign_dir.path)):
-                    ignore = True
-                    break
-            if ignore:
-                continue
-            for f in t[2]:
-                for ext in settings.SUBTITLE_EXTENSIONS:
-                    if f.lower().endswith('.{ext}'.format(ext=ext)):
-                        self.collect_subfile(d, f)
-                        count += 1
-                if count == limit:
-                    break
+        ignore = IgnoreTrie([str(d.path) for d in ignore_directories])
+        extensions = get_extension_set(settings.SUBTITLE_EXTENSIONS)
+        for entry in walk_files(directory, extensions, ignore):
+            self.collect_subfile(os.path.dirname(entry.path), entry.name)
+            count += 1
+            if count == limit:
+                break
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('djmediastreamer', '0009_auto_20170320_2114'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EncoderDowngrade',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dtm', models.DateTimeField(auto_now=True)),
+                ('segment', models.IntegerField()),
+                ('speed', models.FloatField()),
+                ('fps', models.FloatField(blank=True, null=True)),
+                ('from_level', models.IntegerField()),
+                ('to_level', models.IntegerField()),
+                ('mediafile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='djmediastreamer.MediaFile')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('djmediastreamer', '0010_encoderdowngrade'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceProfile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('device_id', models.CharField(max_length=32)),
+                ('user_agent', models.TextField()),
+                ('capabilities', django.contrib.postgres.fields.jsonb.JSONField()),
+                ('dtm', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='deviceprofile',
+            unique_together=set([('user', 'device_id')]),
+        ),
+    ]
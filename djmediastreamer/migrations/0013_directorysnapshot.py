@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djmediastreamer', '0012_transcodejob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DirectorySnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.TextField(unique=True)),
+                ('mtime', models.FloatField()),
+                ('dirs', django.contrib.postgres.fields.jsonb.JSONField(default=list)),
+                ('files', django.contrib.postgres.fields.jsonb.JSONField(default=dict)),
+                ('dtm', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
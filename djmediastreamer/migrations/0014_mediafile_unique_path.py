@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def remove_duplicates(apps, schema_editor):
+    """Keeps the oldest MediaFile of every (directory, file_name) and moves
+    the rows that point to the others to it."""
+    MediaFile = apps.get_model('djmediastreamer', 'MediaFile')
+    relations = [r for r in MediaFile._meta.related_objects if r.one_to_many]
+    duplicates = MediaFile.objects.values('directory', 'file_name').annotate(
+        n=Count('id'), keep=Min('id')).filter(n__gt=1)
+    for d in duplicates:
+        others = MediaFile.objects.filter(
+            directory=d['directory'], file_name=d['file_name']
+        ).exclude(id=d['keep'])
+        other_ids = list(others.values_list('id', flat=True))
+        for r in relations:
+            r.related_model.objects.filter(
+                **{r.field.name + '__in': other_ids}
+            ).update(**{r.field.name: d['keep']})
+        MediaFile.objects.filter(id__in=other_ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djmediastreamer', '0013_directorysnapshot'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='mediafile',
+            unique_together=set([('directory', 'file_name')]),
+        ),
+    ]
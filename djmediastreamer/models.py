@@ -23,6 +23,9 @@ class MediaFile(models.Model):
     v_codec = models.TextField(null=True, blank=True)
     props = JSONField(null=True, blank=True)
 
+    class Meta:
+        unique_together = ('directory', 'file_name')
+
     @property
     def full_path(self):
         return '{d}/{fn}'.format(d=self.directory, fn=self.file_name)
@@ -157,3 +160,64 @@ class TranscodeLog(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     dtm = models.DateTimeField(auto_now=True)
     command = models.TextField()
+
+
+class EncoderDowngrade(models.Model):
+    """A segmented stream that switched to a faster encoder level because a
+    segment was encoded slower than settings.REALTIME_MIN_SPEED, or back to
+    a better one (to_level < from_level) because it was fast again."""
+    mediafile = models.ForeignKey(MediaFile, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    dtm = models.DateTimeField(auto_now=True)
+    segment = models.IntegerField()
+    speed = models.FloatField()
+    fps = models.FloatField(null=True, blank=True)
+    from_level = models.IntegerField()
+    to_level = models.IntegerField()
+
+
+class DeviceProfile(models.Model):
+    """The codecs a browser of a user can play, as reported by the player.
+    device_id is a cookie."""
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    device_id = models.CharField(max_length=32)
+    user_agent = models.TextField()
+    capabilities = JSONField()
+    dtm = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('user', 'device_id')
+
+
+class TranscodeJob(models.Model):
+    """A background transcode. key is a hash of its parameters, identical
+    jobs share it."""
+    key = models.CharField(max_length=40, unique=True)
+    kind = models.CharField(max_length=20)
+    priority = models.IntegerField(default=0)
+    status = models.CharField(max_length=10, default='queued')
+    progress = models.IntegerField(default=0)
+    error = models.TextField(null=True, blank=True)
+    mediafile = models.ForeignKey(MediaFile, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    created = models.DateTimeField(auto_now_add=True)
+    dtm = models.DateTimeField(auto_now=True)
+
+    def as_dict(self):
+        return {
+            'id': self.id, 'kind': self.kind, 'status': self.status,
+            'progress': self.progress, 'error': self.error,
+            'mediafile': self.mediafile_id,
+            'priority': self.priority, 'created': self.created.isoformat(),
+            'updated': self.dtm.isoformat(),
+        }
+
+
+class DirectorySnapshot(models.Model):
+    """What collect_media saw in a directory: its mtime, its subdirectories
+    and the [inode, size, mtime] of its video files by name."""
+    path = models.TextField(unique=True)
+    mtime = models.FloatField()
+    dirs = JSONField(default=list)
+    files = JSONField(default=dict)
+    dtm = models.DateTimeField(auto_now=True)
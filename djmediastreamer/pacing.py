@@ -0,0 +1,288 @@
+"""Paces the streams sent by the uwsgi workers.
+
+The files that are sent as they are (the original or a cached transcode)
+have their own rate, a bit more than their bitrate after a burst at the
+start so the player can fill its buffer. Live transcodes are not paced on
+their own, ffmpeg already produces them at about real time.
+
+All the streams take bytes from one token bucket of settings.STREAM_MAX_RATE
+bytes per second, kept in a file in settings.STREAM_PACING_DIR so it is
+shared by all the workers. Live streams (the ones being watched) can empty
+the bucket, bulk ones (downloads) only take what the live streams of every
+worker leave."""
+import os
+import time
+import fcntl
+import struct
+import weakref
+import threading
+
+from django.conf import settings
+
+from .streaming import StreamMeter
+
+LIVE = 'live'
+BULK = 'bulk'
+
+
+class TokenBucket(object):
+    """rate bytes per second and up to burst bytes saved.
+
+    A block larger than what is saved is sent anyway and the bucket goes
+    into debt, so the blocks don't have to be smaller than the burst."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.last = time.time()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def take(self, n, reserve=0):
+        """Takes n bytes if more than reserve are saved. Returns 0 or the
+        seconds to wait before trying again."""
+        self.refill()
+        if self.tokens > reserve:
+            self.tokens -= n
+            return 0
+        return max((reserve - self.tokens) / float(self.rate), 0.01)
+
+
+class SharedTokenBucket(TokenBucket):
+    """A TokenBucket kept in a file, shared by the processes that use the
+    same path. The file is locked with flock while it is updated."""
+
+    state = struct.Struct('dd')  # tokens, last
+
+    def __init__(self, path, rate, burst=None):
+        super(SharedTokenBucket, self).__init__(rate, burst)
+        self.path = path
+        self.fd = None
+        self.pid = None
+
+    def open(self):
+        # the lock is per open file, a forked worker needs its own
+        if self.fd is None or self.pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if not os.path.exists(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    pass
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.fcntl(self.fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+            self.pid = os.getpid()
+        return self.fd
+
+    def take(self, n, reserve=0):
+        fd = self.open()
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            os.lseek(fd, 0, os.SEEK_SET)
+            data = os.read(fd, self.state.size)
+            if len(data) == self.state.size:
+                self.tokens, self.last = self.state.unpack(data)
+            else:
+                self.tokens, self.last = self.burst, time.time()
+            delay = super(SharedTokenBucket, self).take(n, reserve)
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.write(fd, self.state.pack(self.tokens, self.last))
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        return delay
+
+
+class Pacer(object):
+    """The bandwidth shared by all the streams.
+
+    With a directory the bucket is a SharedTokenBucket and every process
+    writes the bytes per second its live streams need to live_<pid> there
+    (at most once a second), so the bulk streams of one worker also leave
+    room for the live ones of the others."""
+
+    # a bulk stream only takes bytes when this many seconds of what the live
+    # streams need are saved in the bucket
+    live_reserve = 1.0
+    # seconds between updates of the live demand of the other processes
+    demand_interval = 1.0
+    # the demand of a process that didn't update it in this many seconds
+    # is ignored (the process is gone or has no streams)
+    demand_max_age = 5.0
+
+    def __init__(self, rate=None, directory=None):
+        self.lock = threading.Lock()
+        self.directory = directory if rate else None
+        if self.directory:
+            self.bucket = SharedTokenBucket(
+                os.path.join(directory, 'bucket'), rate)
+        else:
+            self.bucket = TokenBucket(rate) if rate else None
+        self.streams = weakref.WeakSet()
+        self.last_demand_update = 0
+        self.other_demand = 0
+
+    def add(self, stream):
+        with self.lock:
+            self.streams.add(stream)
+
+    def remove(self, stream):
+        with self.lock:
+            self.streams.discard(stream)
+
+    def get_streams(self, kind=None):
+        with self.lock:
+            streams = list(self.streams)
+        return [s for s in streams if kind is None or s.kind == kind]
+
+    def local_live_demand(self):
+        return sum([s.target_rate or s.meter.rate
+                    for s in self.get_streams(LIVE)])
+
+    def update_demand(self, demand):
+        """Publishes the live demand of this process and reads the one of
+        the others."""
+        now = time.time()
+        if now - self.last_demand_update < self.demand_interval:
+            return
+        self.last_demand_update = now
+        pid = os.getpid()
+        path = os.path.join(self.directory, 'live_{pid}'.format(pid=pid))
+        temp_path = '{p}.{tid}.tmp'.format(
+            p=path, tid=threading.current_thread().ident)
+        try:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            with open(temp_path, 'w') as fd:
+                fd.write(str(int(demand)))
+            os.rename(temp_path, path)
+            names = os.listdir(self.directory)
+        except (IOError, OSError):
+            return
+        other = 0
+        for name in names:
+            if not name.startswith('live_') or name.endswith('.tmp') or \
+                    name == 'live_{pid}'.format(pid=pid):
+                continue
+            full_path = os.path.join(self.directory, name)
+            try:
+                if now - os.stat(full_path).st_mtime > self.demand_max_age:
+                    continue
+                with open(full_path) as fd:
+                    other += int(fd.read() or 0)
+            except (IOError, OSError, ValueError):
+                continue
+        self.other_demand = other
+
+    def live_demand(self):
+        'Bytes per second the live streams (of every process) need.'
+        demand = self.local_live_demand()
+        if self.directory:
+            self.update_demand(demand)
+            demand += self.other_demand
+        return demand
+
+    def get_bulk_rate(self):
+        'Fair share of what is left for one more bulk stream, or None.'
+        if not self.bucket:
+            return None
+        bulk = len(self.get_streams(BULK))
+        left = max(self.bucket.rate - self.live_demand(),
+                   self.bucket.rate * 0.05)
+        return int(left / (bulk + 1))
+
+    def take(self, n, kind=LIVE):
+        """Takes n bytes from the bucket. Returns 0 or the seconds to wait
+        before trying again."""
+        if not self.bucket:
+            return 0
+        reserve = 0
+        if kind == BULK:
+            reserve = min(self.live_demand() * self.live_reserve,
+                          self.bucket.burst)
+        elif self.directory:
+            # keep the demand of this process up to date for the others
+            self.live_demand()
+        with self.lock:
+            delay = self.bucket.take(n, reserve)
+        return min(delay, 1)
+
+    def as_dict(self):
+        streams = self.get_streams()
+        return {
+            'max_rate': self.bucket.rate if self.bucket else None,
+            'live_demand': self.live_demand(),
+            'streams': [
+                {'kind': s.kind, 'target_rate': s.target_rate,
+                 'rate': s.meter.rate, 'bytes': s.meter.bytes}
+                for s in streams
+            ],
+        }
+
+
+stream_pacer = Pacer(settings.STREAM_MAX_RATE, settings.STREAM_PACING_DIR)
+
+
+def get_stream_rate(mediafile, size=None, start=0):
+    """Returns the (rate, burst) in bytes of a file sent as it is, or
+    (None, None) if its bitrate is unknown. size is the one of the file that
+    is sent (the mediafile's by default) and start the second of the
+    mediafile it begins at (a cached transcode with a goto)."""
+    size = size or mediafile.size
+    duration = (mediafile.duration or 0) - start
+    if not size or duration <= 0:
+        return None, None
+    bitrate = float(size) / duration
+    return (int(bitrate * settings.STREAM_RATE_FACTOR),
+            int(bitrate * settings.STREAM_BURST))
+
+
+class PacedStream(object):
+    'Iterates over a stream at no more than its rate and the pacer allows.'
+
+    def __init__(self, stream, rate=None, burst=None, kind=LIVE,
+                 pacer=stream_pacer):
+        self.stream = stream
+        self.kind = kind
+        self.target_rate = rate
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        # the bytes of the block being sent were taken from self.bucket
+        self.bucket_taken = False
+        self.meter = StreamMeter()
+        self.pacer = pacer
+        pacer.add(self)
+
+    def take(self, n):
+        """Returns 0 when n more bytes can be sent or the seconds to wait
+        before asking again. asgi_stream uses it to wait in its event
+        loop."""
+        if self.bucket and not self.bucket_taken:
+            delay = self.bucket.take(n)
+            if delay:
+                return delay
+            self.bucket_taken = True
+        delay = self.pacer.take(n, self.kind)
+        if delay:
+            return delay
+        self.bucket_taken = False
+        self.meter.add(n)
+        return 0
+
+    def __iter__(self):
+        for chunk in self.stream:
+            n = len(chunk)
+            delay = self.take(n)
+            while delay:
+                time.sleep(delay)
+                delay = self.take(n)
+            yield chunk
+        self.pacer.remove(self)
+
+    def close(self):
+        self.pacer.remove(self)
+        if hasattr(self.stream, 'close'):
+            self.stream.close()
@@ -0,0 +1,100 @@
+"""Decides how a mediafile is sent to a client.
+
+The codecs are the names stored by collect_media in MediaFile.v_codec and
+MediaFile.a_codec (mediainfo formats without spaces)."""
+
+DIRECT = 'direct'  # the original file
+REMUX = 'remux'  # audio and video copied into another container
+AUDIO = 'audio'  # video copied, audio transcoded
+TRANSCODE = 'transcode'
+
+# containers in order of preference
+CONTAINERS = ['mp4', 'webm', 'matroska']
+
+EXTENSION_CONTAINERS = {
+    'mp4': 'mp4',
+    'm4v': 'mp4',
+    'webm': 'webm',
+    'mkv': 'matroska',
+}
+
+CONTAINER_EXTENSIONS = {
+    'mp4': 'mp4',
+    'webm': 'webm',
+    'matroska': 'mkv',
+}
+
+CONTAINER_MIMETYPES = {
+    'mp4': 'video/mp4',
+    'webm': 'video/webm',
+    # browsers that play matroska do it through their webm support
+    'matroska': 'video/webm',
+}
+
+# the ffmpeg encoder used when the audio has to be transcoded
+AUDIO_ENCODERS = {
+    'mp4': 'aac',
+    'webm': 'libopus',
+    'matroska': 'libopus',
+}
+
+
+def get_client_capabilities(request):
+    """Returns the video and audio codecs the client can play in every
+    container."""
+    ua = request.META.get('HTTP_USER_AGENT', '')
+    capabilities = {
+        'mp4': {'video': {'AVC'}, 'audio': {'AAC', 'MPEGAudio'}},
+        'webm': {'video': {'VP8', 'VP9'}, 'audio': {'Vorbis', 'Opus'}},
+    }
+    if 'Chrome' in ua and 'Android' not in ua:
+        capabilities['matroska'] = {
+            'video': {'AVC', 'VP8', 'VP9'},
+            'audio': {'AAC', 'MPEGAudio', 'Vorbis', 'Opus'},
+        }
+    return capabilities
+
+
+class Playback(object):
+    def __init__(self, mode, container):
+        self.mode = mode
+        self.container = container
+
+    @property
+    def mimetype(self):
+        return CONTAINER_MIMETYPES[self.container]
+
+    @property
+    def extension(self):
+        return CONTAINER_EXTENSIONS[self.container]
+
+    @property
+    def audio_codec(self):
+        'The ffmpeg audio codec to use when remuxing.'
+        return AUDIO_ENCODERS[self.container] if self.mode == AUDIO \
+            else 'copy'
+
+
+def choose_playback(mediafile, capabilities, goto=None, subtitles=None):
+    """Returns the cheapest Playback the client can play.
+
+    Burned in subtitles always need a transcode."""
+    source = EXTENSION_CONTAINERS.get(mediafile.extension)
+    containers = [c for c in CONTAINERS if c in capabilities]
+    if source in containers:
+        containers.remove(source)
+        containers.insert(0, source)
+    if not subtitles:
+        playable = [c for c in containers
+                    if mediafile.v_codec in capabilities[c]['video']]
+        for container in playable:
+            if not mediafile.a_codec or \
+                    mediafile.a_codec in capabilities[container]['audio']:
+                if container == source and not goto:
+                    return Playback(DIRECT, container)
+                return Playback(REMUX, container)
+        if playable:
+            return Playback(AUDIO, playable[0])
+    if 'matroska' in capabilities:
+        return Playback(TRANSCODE, 'matroska')
+    return Playback(TRANSCODE, 'webm')
@@ -0,0 +1,49 @@
+"""Encodes the first segments of the file that comes after the one being
+watched, so starting the next episode doesn't wait for ffmpeg.
+
+Prewarming only runs while the host is idle: the load average is under
+settings.PREWARM_MAX_LOAD per core, one transcode slot is left free for the
+viewers and the cache disk has settings.PREWARM_MIN_FREE_SPACE bytes free."""
+import os
+import multiprocessing
+
+from django.conf import settings
+
+from . import hls
+from .models import MediaFile
+from .scheduler import transcode_scheduler
+
+
+def get_next_mediafile(mediafile):
+    'Returns the next file of the directory (by name) or None.'
+    return MediaFile.objects.filter(
+        directory=mediafile.directory, file_name__gt=mediafile.file_name
+    ).order_by('file_name').first()
+
+
+def should_prewarm(mediafile, old_position, position):
+    """Whether the viewer just went past settings.PREWARM_AT (a fraction of
+    the duration)."""
+    if not settings.PREWARM or not mediafile.duration:
+        return False
+    threshold = mediafile.duration * settings.PREWARM_AT
+    return (old_position or 0) < threshold <= position
+
+
+def get_prewarm_segments(mediafile):
+    count = int(settings.PREWARM_DURATION // settings.SEGMENT_DURATION) or 1
+    return range(min(count, hls.get_segments_count(mediafile)))
+
+
+def has_budget():
+    'Whether there is idle CPU, a spare slot and disk for prewarming.'
+    if os.getloadavg()[0] > \
+            settings.PREWARM_MAX_LOAD * multiprocessing.cpu_count():
+        return False
+    if transcode_scheduler.active_sessions() >= transcode_scheduler.slots - 1:
+        return False
+    directory = settings.SEGMENTS_DIR
+    if not os.path.exists(directory):
+        directory = settings.BASE_DIR
+    st = os.statvfs(directory)
+    return st.f_bavail * st.f_frsize >= settings.PREWARM_MIN_FREE_SPACE
@@ -0,0 +1,143 @@
+"""Reads the streams of a file with a single `mediainfo --Output=JSON` call.
+
+The codecs are stored like MediaInfo did (mediainfo formats without spaces),
+so playback.py keeps working with them. Every stream is kept in
+MediaFile.props['streams'] so the playback decisions and the subtitle track
+selection don't need to probe the file again.
+
+mediainfo has JSON output since 18.03 (see has_json_output). With an older
+one the text output is parsed by utils.MediaInfo, the columns are filled but
+props is not."""
+import re
+import json
+import subprocess
+
+from .utils import MediaInfo, with_timeout
+
+JSON_OUTPUT_VERSION = (18, 3)
+
+STREAM_TYPES = {'Video': 'video', 'Audio': 'audio', 'Text': 'subtitle'}
+
+
+def to_int(value):
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_codec(track):
+    codec = track.get('Format')
+    if not codec:
+        return None
+    return codec.replace(' ', '').replace('MPEG-4Visual', 'MPEG-4')
+
+
+def get_tracks(output):
+    media = json.loads(output).get('media') or {}
+    tracks = media.get('track') or []
+    # a file with a single track is not always in a list
+    return tracks if isinstance(tracks, list) else [tracks]
+
+
+def parse_stream(track):
+    kind = STREAM_TYPES[track['@type']]
+    stream = {
+        'type': kind,
+        'index': to_int(track.get('StreamOrder')),
+        'codec': get_codec(track),
+        'codec_id': track.get('CodecID'),
+        'bitrate': to_int(track.get('BitRate')),
+        'language': track.get('Language'),
+        'title': track.get('Title'),
+        'default': track.get('Default') == 'Yes',
+        'forced': track.get('Forced') == 'Yes',
+    }
+    if kind == 'video':
+        stream.update({
+            'profile': track.get('Format_Profile'),
+            'width': to_int(track.get('Width')),
+            'height': to_int(track.get('Height')),
+            'frame_rate': to_float(track.get('FrameRate')),
+            'duration': to_float(track.get('Duration')),
+        })
+    elif kind == 'audio':
+        stream.update({
+            'profile': track.get('Format_Profile'),
+            'channels': to_int(track.get('Channels')),
+            'sample_rate': to_int(track.get('SamplingRate')),
+            'duration': to_float(track.get('Duration')),
+        })
+    return stream
+
+
+def parse_mediainfo(output):
+    """Returns the props of a file, {'container', 'duration', 'bitrate',
+    'streams'}, from the JSON output of mediainfo. Durations are in seconds
+    with milliseconds."""
+    props = {'container': None, 'duration': None, 'bitrate': None,
+             'streams': []}
+    for track in get_tracks(output):
+        if track.get('@type') == 'General':
+            props['container'] = track.get('Format')
+            props['duration'] = to_float(track.get('Duration'))
+            props['bitrate'] = to_int(track.get('OverallBitRate'))
+        elif track.get('@type') in STREAM_TYPES:
+            props['streams'].append(parse_stream(track))
+    return props
+
+
+def get_fields(props):
+    'Returns the values of the MediaFile columns from the props of a file.'
+    video = get_streams(props, 'video')
+    audio = get_streams(props, 'audio')
+    v = video[0] if video else {}
+    duration = v.get('duration') or props.get('duration')
+    return {
+        'width': v.get('width'),
+        'height': v.get('height'),
+        'v_codec': v.get('codec'),
+        'a_codec': audio[0]['codec'] if audio else None,
+        'duration': int(duration) if duration is not None else None,
+        'props': props,
+    }
+
+
+def has_json_output():
+    'Whether the installed mediainfo has --Output=JSON.'
+    try:
+        output = subprocess.check_output(['mediainfo', '--Version'])
+    except (subprocess.CalledProcessError, OSError):
+        return False
+    match = re.search(r'v([0-9]+)\.([0-9]+)', output.decode('utf8', 'replace'))
+    if not match:
+        return False
+    version = (int(match.group(1)), int(match.group(2)))
+    return version >= JSON_OUTPUT_VERSION
+
+
+def probe_media(full_path, timeout=None, json_output=True):
+    """Returns the MediaFile fields of a file, with json_output (see
+    has_json_output) props included. Raises CalledProcessError when
+    mediainfo fails or is killed after timeout seconds."""
+    if not json_output:
+        return MediaInfo(full_path, timeout).get_fields()
+    output = subprocess.check_output(with_timeout(
+        ['mediainfo', '--Output=JSON', full_path], timeout))
+    return get_fields(parse_mediainfo(output))
+
+
+def get_streams(props, kind=None):
+    """Returns the streams stored in some props (or a MediaFile), only the
+    ones of a type (video, audio or subtitle) if kind is given."""
+    if hasattr(props, 'props'):
+        props = props.props
+    streams = (props or {}).get('streams') or []
+    return [s for s in streams if kind is None or s['type'] == kind]
@@ -0,0 +1,95 @@
+"""Walks directory trees without building lists of paths.
+
+Directories are read with scandir, so telling files from directories
+doesn't need a stat call per entry (the type comes with the entry on most
+filesystems), ignored directories are pruned before going into them and the
+extensions are looked up in a set."""
+try:
+    from os import scandir
+except ImportError:
+    # python 2
+    from scandir import scandir
+
+
+def get_extension_set(extensions):
+    return frozenset([e.lower().lstrip('.') for e in extensions])
+
+
+def has_extension(name, extension_set):
+    if '.' not in name:
+        return False
+    return name.rsplit('.', 1)[1].lower() in extension_set
+
+
+def split_path(path):
+    return [p for p in path.split('/') if p]
+
+
+class IgnoreTrie(object):
+    """A set of directories that matches them and everything under them.
+
+    The paths are compared by component, so /data/tv doesn't match
+    /data/tv2."""
+
+    END = None
+
+    def __init__(self, paths=()):
+        self.root = {}
+        for path in paths:
+            self.add(path)
+
+    def add(self, path):
+        node = self.root
+        for part in split_path(path):
+            node = node.setdefault(part, {})
+        node[self.END] = True
+
+    def __contains__(self, path):
+        node = self.root
+        if self.END in node:
+            return True
+        for part in split_path(path):
+            node = node.get(part)
+            if node is None:
+                return False
+            if self.END in node:
+                return True
+        return False
+
+
+def scan_directory(path, extension_set=None, ignore=None):
+    """Returns the (directories, files) DirEntries of a directory.
+
+    Only the files with an extension in extension_set (all of them if it is
+    None) and the directories not in ignore (an IgnoreTrie) are returned.
+    Like os.walk, links to files count and links to directories are not
+    followed."""
+    dirs = []
+    files = []
+    for entry in scandir(path):
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                if ignore is None or entry.path not in ignore:
+                    dirs.append(entry)
+            elif (extension_set is None or
+                    has_extension(entry.name, extension_set)) and \
+                    entry.is_file():
+                files.append(entry)
+        except OSError:
+            continue
+    return dirs, files
+
+
+def walk_files(root, extension_set=None, ignore=None):
+    'Yields the DirEntries of the files of a tree, see scan_directory.'
+    if ignore is not None and root in ignore:
+        return
+    stack = [root]
+    while stack:
+        try:
+            dirs, files = scan_directory(stack.pop(), extension_set, ignore)
+        except OSError:
+            continue
+        for entry in files:
+            yield entry
+        stack.extend([d.path for d in reversed(dirs)])
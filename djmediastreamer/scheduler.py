@@ -0,0 +1,148 @@
+import os
+import sys
+import time
+import fcntl
+import multiprocessing
+
+from django.conf import settings
+
+# python 2 has no os.O_CLOEXEC, the flag is also set with fcntl
+O_CLOEXEC = getattr(os, 'O_CLOEXEC', 0)
+
+
+class NoTranscodeSlot(Exception):
+    pass
+
+
+class TranscodeSlot(object):
+    """A locked slot file.
+
+    The file descriptor is inherited by the ffmpeg process, so the slot stays
+    taken until ffmpeg exits even after release() is called here. It is
+    opened close-on-exec, only the process started with the slot (see
+    inherit()) keeps it."""
+
+    def __init__(self, fd, number):
+        self.fd = fd
+        self.number = number
+
+    def inherit(self):
+        'Lets the process about to be executed keep the slot.'
+        flags = fcntl.fcntl(self.fd, fcntl.F_GETFD)
+        fcntl.fcntl(self.fd, fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC)
+
+    def popen_kwargs(self):
+        'The subprocess.Popen arguments that give the slot to the process.'
+        if sys.version_info[0] > 2:
+            return {'pass_fds': (self.fd,)}
+        # python 2 has no pass_fds, the fd stays close-on-exec until the fork
+        return {'preexec_fn': self.inherit}
+
+    def release(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class TranscodeScheduler(object):
+    """Limits the ffmpeg processes running in the host.
+
+    There are settings.TRANSCODE_SLOTS slot files in
+    settings.TRANSCODE_SLOTS_DIR and every transcode holds an exclusive lock
+    on one of them, so the limit is shared by all the uwsgi workers and a slot
+    is freed as soon as its process dies. Looking for a free slot and
+    counting the taken ones lock slots.lock, so a count never makes a slot
+    look taken to somebody looking for one."""
+
+    def __init__(self, directory=None, slots=None, queue_timeout=None):
+        self.directory = directory or settings.TRANSCODE_SLOTS_DIR
+        self.slots = slots or settings.TRANSCODE_SLOTS
+        self.queue_timeout = queue_timeout if queue_timeout is not None \
+            else settings.TRANSCODE_QUEUE_TIMEOUT
+
+    def open_file(self, name):
+        if not os.path.exists(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                pass
+        path = os.path.join(self.directory, name)
+        # not inherited by the processes of other requests
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | O_CLOEXEC, 0o644)
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        return fd
+
+    def open_slot(self, number):
+        return self.open_file('slot_{n}'.format(n=number))
+
+    def lock_slots(self):
+        'Returns the fd of the locked slots.lock, close it to unlock.'
+        fd = self.open_file('slots.lock')
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    def try_acquire(self):
+        'Returns a TranscodeSlot or None if all of them are taken.'
+        guard = self.lock_slots()
+        try:
+            for n in range(self.slots):
+                fd = self.open_slot(n)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    os.close(fd)
+                    continue
+                return TranscodeSlot(fd, n)
+        finally:
+            os.close(guard)
+        return None
+
+    def acquire(self, timeout=None):
+        """Waits until a slot is free. Raises NoTranscodeSlot if that takes
+        more than timeout seconds."""
+        if timeout is None:
+            timeout = self.queue_timeout
+        deadline = time.time() + timeout
+        while True:
+            slot = self.try_acquire()
+            if slot:
+                return slot
+            if time.time() >= deadline:
+                raise NoTranscodeSlot()
+            time.sleep(0.5)
+
+    def acquire_background(self, interval=1):
+        """Waits as long as needed for a slot for a background encode. One
+        slot is left for the live sessions when there is more than one."""
+        reserved = 1 if self.slots > 1 else 0
+        while True:
+            if self.active_sessions() < self.slots - reserved:
+                slot = self.try_acquire()
+                if slot:
+                    return slot
+            time.sleep(interval)
+
+    def active_sessions(self):
+        count = 0
+        guard = self.lock_slots()
+        try:
+            for n in range(self.slots):
+                fd = self.open_slot(n)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                except (IOError, OSError):
+                    count += 1
+                finally:
+                    os.close(fd)
+        finally:
+            os.close(guard)
+        return count
+
+    def get_threads(self):
+        'Splits the cores between the running transcodes.'
+        return max(1, multiprocessing.cpu_count() //
+                   max(1, self.active_sessions()))
+
+
+transcode_scheduler = TranscodeScheduler()
@@ -0,0 +1,113 @@
+"""Incremental scans of a directory tree.
+
+A directory's mtime changes when an entry is added, removed or renamed in
+it, so when it is the same as in its DirectorySnapshot it is not listed and
+only its stored subdirectories are visited. A file changed in place keeps
+the mtime of its directory, so the stored videos of the directory are
+stat'ed and compared with their signatures (inode, size, mtime): the
+directory is only listed (and looked up in the db) when one of them
+changed."""
+import os
+
+from django.db.models import Q
+
+from .models import DirectorySnapshot
+from .scanning import IgnoreTrie, get_extension_set, scan_directory
+
+
+def get_signature(st):
+    return [st.st_ino, st.st_size, int(st.st_mtime)]
+
+
+class SnapshotWalker(object):
+    def __init__(self, extensions, ignore_paths=(), full=False):
+        self.extensions = get_extension_set(extensions)
+        self.ignore = IgnoreTrie(ignore_paths)
+        self.full = full
+        self.changed = {}
+        self.removed = []
+        self.seen = set()
+        self.first_scan = False
+
+    def is_ignored(self, path):
+        return path in self.ignore
+
+    def list_directory(self, path):
+        'Returns the subdirectories and the {name: signature} of the videos.'
+        # ignored directories are kept in the snapshot (and skipped by walk)
+        # so they are visited if they stop being ignored
+        dirs, entries = scan_directory(path, self.extensions)
+        files = {}
+        for entry in entries:
+            try:
+                files[entry.name] = get_signature(entry.stat())
+            except OSError:
+                continue
+        return sorted([d.name for d in dirs]), files
+
+    def files_changed(self, path, files):
+        'Whether a video of a {name: signature} changed or is gone.'
+        for name, signature in files.items():
+            try:
+                st = os.stat(os.path.join(path, name))
+            except OSError:
+                return True
+            if get_signature(st) != list(signature):
+                return True
+        return False
+
+    def walk(self, root):
+        """Yields (path, files, old_files) for every directory that changed
+        since its snapshot. files are the {name: signature} of its videos
+        now and old_files the ones in the snapshot ({} if it had none).
+
+        When the walk ends, removed has the directories that have a snapshot
+        but don't exist anymore and seen the ones that were visited."""
+        root = root.rstrip('/') or '/'
+        known = dict([
+            (s.path, s) for s in DirectorySnapshot.objects.filter(
+                Q(path=root) | Q(path__startswith=root.rstrip('/') + '/'))
+        ])
+        self.first_scan = not known
+        seen = self.seen
+        stack = [root]
+        while stack:
+            path = stack.pop()
+            if self.is_ignored(path):
+                continue
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            seen.add(path)
+            snapshot = known.get(path)
+            if snapshot and snapshot.mtime == mtime and not self.full and \
+                    not self.files_changed(path, snapshot.files or {}):
+                stack.extend([os.path.join(path, d) for d in snapshot.dirs])
+                continue
+            try:
+                dirs, files = self.list_directory(path)
+            except OSError:
+                continue
+            if snapshot is None:
+                snapshot = DirectorySnapshot(path=path)
+            old_files = snapshot.files or {}
+            snapshot.mtime = mtime
+            snapshot.dirs = dirs
+            snapshot.files = files
+            self.changed[path] = snapshot
+            stack.extend([os.path.join(path, d) for d in dirs])
+            yield path, files, old_files
+        self.removed = [p for p in known
+                        if p not in seen and not self.is_ignored(p)]
+
+    def forget(self, path):
+        'Makes the next scan list the directory again.'
+        if path in self.changed:
+            self.changed[path].mtime = 0
+
+    def save(self):
+        for snapshot in self.changed.values():
+            snapshot.save()
+        if self.removed:
+            DirectorySnapshot.objects.filter(path__in=self.removed).delete()
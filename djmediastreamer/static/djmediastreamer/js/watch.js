@@ -29,6 +29,41 @@ $(document).ready(function(){
   });
 
 
+  if (typeof hls_url !== 'undefined') {
+    var video = document.getElementById('video');
+    if (video.canPlayType('application/vnd.apple.mpegurl')) {
+      video.src = hls_url;
+      $('#video').one('loadedmetadata', function () {
+        this.currentTime = start_position;
+      });
+    } else if (Hls.isSupported()) {
+      var hls = new Hls({startPosition: start_position});
+      hls.loadSource(hls_url);
+      hls.attachMedia(video);
+    }
+  }
+
+  if (typeof device_probes !== 'undefined') {
+    // tell the server what this browser can play
+    var results = {};
+    var probe = document.createElement('video');
+    $.each(device_probes, function(i, type) {
+      results[type] = probe.canPlayType(type);
+    });
+    $.ajax({
+      url: device_profile_url,
+      type: 'POST',
+      contentType: 'application/json',
+      data: JSON.stringify(results),
+      success: function(r) {
+        if (r.changed && typeof hls_url === 'undefined') {
+          // this page was made with guessed capabilities
+          location.reload();
+        }
+      }
+    });
+  }
+
   $("#video").bind("loadedmetadata", function () {
     $('#progress-bar-parent').css('width', this.videoWidth+'px');
   });
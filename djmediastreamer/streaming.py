@@ -0,0 +1,241 @@
+import os
+import re
+import time
+import weakref
+import threading
+from collections import deque
+
+from django.conf import settings
+
+from .cache import transcode_cache
+
+PROGRESS_RE = re.compile(r'\b(fps|speed)=\s*([0-9.]+)')
+TIME_RE = re.compile(r'\btime=\s*([0-9]+):([0-9]+):([0-9.]+)')
+
+
+def parse_progress(line):
+    """Returns the fps, speed (a factor of realtime) and time (seconds of
+    output) of an ffmpeg progress line, ie: frame=  240 fps= 48 q=28.0
+    size= 1024kB time=00:00:10.00 bitrate= 838.9kbits/s speed=1.92x"""
+    res = {}
+    for name, value in PROGRESS_RE.findall(line):
+        try:
+            res[name] = float(value)
+        except ValueError:
+            continue
+    match = TIME_RE.search(line)
+    if match:
+        h, m, s = match.groups()
+        try:
+            res['time'] = int(h) * 3600 + int(m) * 60 + float(s)
+        except ValueError:
+            pass
+    return res
+
+
+class StreamMeter(object):
+    'Counts the bytes sent by a stream.'
+
+    def __init__(self):
+        self.started = time.time()
+        self.bytes = 0
+
+    def add(self, n):
+        self.bytes += n
+
+    @property
+    def rate(self):
+        'Average bytes per second since the stream started.'
+        elapsed = time.time() - self.started
+        return int(self.bytes / elapsed) if elapsed > 0 else 0
+
+
+def iter_blocks(fd, block_size=None, meter=None, limit=None):
+    """Reads fd in blocks of block_size bytes (the last one can be smaller),
+    up to limit bytes if it is given.
+
+    The data is read into one reused buffer, so the only copy made per block
+    is the one that is yielded."""
+    block_size = block_size or settings.STREAM_BLOCK_SIZE
+    view = memoryview(bytearray(block_size))
+    remaining = limit
+    while True:
+        size = block_size if remaining is None else min(block_size, remaining)
+        n = 0
+        while n < size:
+            read = fd.readinto(view[n:size])
+            if not read:
+                break
+            n += read
+        if n == 0:
+            break
+        if remaining is not None:
+            remaining -= n
+        if meter:
+            meter.add(n)
+        yield view[:n].tobytes()
+
+
+class FileStream(object):
+    """Iterates over the blocks of an open file (up to length bytes from
+    its current position) and closes it."""
+
+    def __init__(self, fd, block_size=None, length=None):
+        self.fd = fd
+        self.block_size = block_size
+        self.length = length
+
+    def __iter__(self):
+        return iter_blocks(self.fd, self.block_size, limit=self.length)
+
+    def close(self):
+        self.fd.close()
+
+
+class StreamStats(object):
+    """Counters of the transcode processes started by this process.
+
+    orphaned are the processes that were still running when their stream was
+    closed (the viewer went away) and reaped the ones that were waited for."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {'started': 0, 'running': 0, 'orphaned': 0,
+                         'reaped': 0}
+        self.streams = weakref.WeakSet()
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def add_stream(self, stream):
+        with self.lock:
+            self.streams.add(stream)
+
+    def remove_stream(self, stream):
+        with self.lock:
+            self.streams.discard(stream)
+
+    def as_dict(self):
+        with self.lock:
+            res = dict(self.counters)
+            res['streams'] = [
+                {'pid': s.process.pid, 'bytes': s.meter.bytes,
+                 'rate': s.meter.rate, 'speed': s.progress.get('speed'),
+                 'fps': s.progress.get('fps')}
+                for s in self.streams
+            ]
+        return res
+
+
+stream_stats = StreamStats()
+
+
+class TranscodeStream(object):
+    """The output of an ffmpeg process.
+
+    A thread drains stderr so ffmpeg never blocks writing to it and keeps the
+    last fps and speed it reported in progress. close() terminates the
+    process if it is still running and waits for it."""
+
+    # seconds to wait after SIGTERM before sending SIGKILL
+    kill_timeout = 5
+
+    def __init__(self, process, block_size=None):
+        self.process = process
+        self.block_size = block_size
+        self.meter = StreamMeter()
+        self.stderr_tail = deque(maxlen=20)
+        self.progress = {}
+        self.lock = threading.Lock()
+        self.closed = False
+        self.stderr_thread = threading.Thread(target=self.drain_stderr)
+        self.stderr_thread.daemon = True
+        self.stderr_thread.start()
+        stream_stats.incr('started')
+        stream_stats.incr('running')
+        stream_stats.add_stream(self)
+
+    def drain_stderr(self):
+        # ffmpeg ends the progress lines with \r, not \n
+        fd = self.process.stderr.fileno()
+        pending = b''
+        while True:
+            data = os.read(fd, 4096)
+            if not data:
+                break
+            lines = re.split(b'[\r\n]', pending + data)
+            pending = lines.pop()
+            for line in lines:
+                if line:
+                    self.add_stderr_line(line)
+        if pending:
+            self.add_stderr_line(pending)
+
+    def add_stderr_line(self, line):
+        line = line.decode('utf8', 'replace')
+        self.stderr_tail.append(line)
+        progress = parse_progress(line)
+        if progress:
+            self.progress.update(progress)
+
+    def __iter__(self):
+        return iter_blocks(self.process.stdout, self.block_size, self.meter)
+
+    def wait(self):
+        'Waits for the process to finish and returns its exit code.'
+        self.process.wait()
+        self.close()
+        return self.process.returncode
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        if self.process.poll() is None:
+            stream_stats.incr('orphaned')
+            self.process.terminate()
+            deadline = time.time() + self.kill_timeout
+            while self.process.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            if self.process.poll() is None:
+                self.process.kill()
+        self.process.wait()
+        self.stderr_thread.join(self.kill_timeout)
+        stream_stats.incr('running', -1)
+        stream_stats.incr('reaped')
+        stream_stats.remove_stream(self)
+
+
+class CachingStream(object):
+    """Iterates over a TranscodeStream and keeps a copy of its output.
+
+    The copy is moved into the transcode cache only when the whole output
+    was streamed and ffmpeg finished without errors. The temp file is
+    created right away and flushed after every chunk, so it can be read
+    while it is written (see broker.SharedTranscode)."""
+
+    def __init__(self, stream, path, cache=transcode_cache):
+        self.stream = stream
+        self.path = path
+        self.cache = cache
+        self.temp_path = cache.get_temp_path(path)
+        self.fd = open(self.temp_path, 'wb')
+        self.finished = False
+
+    def __iter__(self):
+        with self.fd:
+            for chunk in self.stream:
+                self.fd.write(chunk)
+                self.fd.flush()
+                yield chunk
+        if self.stream.wait() == 0:
+            self.cache.put(self.temp_path, self.path)
+            self.finished = True
+
+    def close(self):
+        self.stream.close()
+        self.fd.close()
+        if not self.finished:
+            self.cache.discard(self.temp_path)
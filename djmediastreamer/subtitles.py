@@ -0,0 +1,301 @@
+from __future__ import unicode_literals
+
+import io
+import os
+import re
+import time
+import shutil
+import tempfile
+import subprocess
+
+import enzyme
+from django.conf import settings
+from django.core.management import call_command
+
+ASS_HEADER = """[Script Info]
+ScriptType: v4.00+
+PlayResX: 384
+PlayResY: 288
+WrapStyle: 0
+
+[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
+Style: Default,Arial,16,&Hffffff,&Hffffff,&H0,&H0,0,0,0,0,100,100,0,0,1,1,0,2,10,10,10,0
+Style: Top,Arial,16,&Hffffff,&Hffffff,&H0,&H0,0,0,0,0,100,100,0,0,1,1,0,8,10,10,10,0
+
+[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+"""
+
+ASS_TAGS = [
+    ('<i>', '{\\i1}'), ('</i>', '{\\i0}'),
+    ('<b>', '{\\b1}'), ('</b>', '{\\b0}'),
+    ('<u>', '{\\u1}'), ('</u>', '{\\u0}'),
+]
+
+
+def format_vtt_time(seconds):
+    ms = int(round(seconds * 1000))
+    return '{h:02d}:{m:02d}:{s:02d}.{ms:03d}'.format(
+        h=ms // 3600000, m=ms // 60000 % 60, s=ms // 1000 % 60, ms=ms % 1000)
+
+
+def format_ass_time(seconds):
+    cs = int(round(seconds * 100))
+    return '{h:d}:{m:02d}:{s:02d}.{cs:02d}'.format(
+        h=cs // 360000, m=cs // 6000 % 60, s=cs // 100 % 60, cs=cs % 100)
+
+
+def get_srclang(language):
+    'Returns the two letters code of a language name, ie: english -> en.'
+    for k, v in sorted(settings.LANGUAGES.items()):
+        if v == language and len(k) == 2:
+            return k
+    return ''
+
+
+def get_cues(subtitles_file, offset=0, keep_on_screen=False):
+    """Returns the (start, end, text) of every line of a SubtitlesFile, in
+    seconds from offset. The lines that end before offset are skipped.
+
+    With keep_on_screen the lines are shown up to 5 more seconds, without
+    overlapping the next one (like the export_subtitles command)."""
+    lines = list(subtitles_file.lines.order_by('start'))
+    res = []
+    for i, line in enumerate(lines):
+        start = line.start_in_seconds
+        end = line.end_in_seconds
+        if keep_on_screen and i < len(lines) - 1:
+            next_start = lines[i + 1].start_in_seconds
+            end = max(end, min(end + 5, next_start - 0.2))
+        if end - offset <= 0:
+            continue
+        res.append((max(start - offset, 0), end - offset, line.text))
+    return res
+
+
+def to_vtt_text(text):
+    """Escapes a cue payload. The <i>, <b> and <u> tags of the srt lines are
+    kept, <font> ones are removed."""
+    text = re.sub(r'</?font[^>]*>', '', text, flags=re.IGNORECASE)
+    text = text.replace('&', '&amp;').replace('-->', '--&gt;')
+    return re.sub(r'<(?!/?[ibu]>)', '&lt;', text)
+
+
+def render_webvtt(subtitles_file, offset=0):
+    """Returns the lines of a SubtitlesFile as WebVTT.
+
+    offset (in seconds) is subtracted from every cue, it is used when the
+    video starts at that position."""
+    res = ['WEBVTT', '']
+    for start, end, text in get_cues(subtitles_file, offset):
+        # an empty line ends the cue
+        text = '\n'.join([to_vtt_text(l) for l in
+                          text.replace('\r', '').split('\n') if l.strip()])
+        res.append('{s} --> {e}'.format(
+            s=format_vtt_time(start), e=format_vtt_time(end)))
+        res.append(text)
+        res.append('')
+    return '\n'.join(res)
+
+
+def to_ass_text(text):
+    for tag, ass_tag in ASS_TAGS:
+        text = text.replace(tag, ass_tag)
+    text = re.sub('<[^>]*>', '', text)
+    return text.replace('\r', '').strip().replace('\n', '\\N')
+
+
+class SubtitlesStore(object):
+    """Subtitles files prepared to be burned in a video.
+
+    They are kept in settings.SUBTITLES_CACHE_DIR and reused between
+    requests. Every job works in its own scratch directory and its result is
+    moved into the store with a rename, so concurrent requests never see (or
+    overwrite) half written files. Files older than
+    settings.SUBTITLES_CACHE_MAX_AGE seconds are removed, and the least
+    recently used ones when the store grows over
+    settings.SUBTITLES_CACHE_MAX_SIZE bytes."""
+
+    # don't clean up more than once every this seconds
+    cleanup_interval = 600
+    # scratch directories left behind by jobs that died
+    scratch_max_age = 3600
+
+    def __init__(self, directory=None, max_age=None, max_size=None):
+        self.directory = directory or settings.SUBTITLES_CACHE_DIR
+        self.max_age = max_age or settings.SUBTITLES_CACHE_MAX_AGE
+        self.max_size = max_size or settings.SUBTITLES_CACHE_MAX_SIZE
+        self.scratch_directory = os.path.join(self.directory, 'scratch')
+        self.last_cleanup = 0
+
+    def get_path(self, name):
+        if not os.path.exists(self.scratch_directory):
+            try:
+                os.makedirs(self.scratch_directory)
+            except OSError:
+                pass
+        return os.path.join(self.directory, name)
+
+    def get(self, name):
+        'Returns the path of a stored file or None if it is not stored.'
+        path = self.get_path(name)
+        if os.path.exists(path):
+            os.utime(path, None)
+            return path
+        return None
+
+    def make_scratch_directory(self):
+        return tempfile.mkdtemp(dir=self.scratch_directory)
+
+    def publish(self, temp_path, name):
+        path = self.get_path(name)
+        os.rename(temp_path, path)
+        self.cleanup()
+        return path
+
+    def prepare(self, subtitles_file, offset=None, keep_on_screen=False):
+        """Returns the path of an UTF-8 srt file with the subtitles, starting
+        at offset (HH:MM:SS)."""
+        name = '{id}_{o}_{k}.srt'.format(
+            id=subtitles_file.id, o=(offset or '0').replace(':', ''),
+            k='keep' if keep_on_screen else 'orig')
+        path = self.get(name)
+        if path:
+            return path
+        scratch = self.make_scratch_directory()
+        try:
+            subtitle_path = self.extract(subtitles_file, scratch,
+                                         keep_on_screen)
+            subtitle_path = self.to_utf8(subtitle_path, scratch)
+            if offset:
+                new_path = os.path.join(scratch, 'ss.srt')
+                subprocess.check_output([
+                    'ffmpeg', '-i', subtitle_path, '-ss', offset, '-f', 'srt',
+                    '-y', new_path
+                ], stderr=subprocess.STDOUT)
+                subtitle_path = new_path
+            if not subtitle_path.startswith(scratch):
+                # never move the original file
+                new_path = os.path.join(scratch, 'copy.srt')
+                shutil.copyfile(subtitle_path, new_path)
+                subtitle_path = new_path
+            return self.publish(subtitle_path, name)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    def extract(self, s, scratch, keep_on_screen=False):
+        if keep_on_screen:
+            subtitle_path = os.path.join(scratch, 'keep.srt')
+            call_command('export_subtitles', s.id, subtitle_path, True)
+            return subtitle_path
+        full_path = os.path.join(s.directory, s.file_name)
+        if not s.is_internal:
+            return full_path
+        with open(full_path, 'rb') as fd:
+            mkv = enzyme.MKV(fd)
+        # TODO: check which track number instead of using the first one
+        tracks = [t for t in mkv.subtitle_tracks
+                  if t.codec_id == 'S_TEXT/UTF8']
+        if not tracks:
+            # ASS or image (PGS, VobSub) tracks are not srt
+            raise ValueError('{f} has no S_TEXT/UTF8 subtitles track'.format(
+                f=full_path))
+        sub_track = tracks[0]
+        subtitle_path = os.path.join(scratch, 'subtitle.srt')
+        subprocess.check_output([
+            'mkvextract', 'tracks', full_path,
+            '{n}:{e}'.format(n=sub_track.number - 1, e=subtitle_path)
+        ])
+        return subtitle_path
+
+    def to_utf8(self, subtitle_path, scratch):
+        output = subprocess.check_output(['file', subtitle_path])
+        from_code = None
+        # the output of file is bytes
+        if b'ISO-8859' in output or b'Non-ISO extended-ASCII' in output:
+            from_code = 'ISO-8859-1'
+        elif b'ASCII' in output:
+            from_code = 'ASCII'
+        if not from_code:
+            return subtitle_path
+        new_path = os.path.join(scratch, 'utf8.srt')
+        with open(new_path, 'wb') as fd:
+            subprocess.check_call([
+                'iconv', '--from-code=' + from_code, '--to-code=UTF-8',
+                subtitle_path
+            ], stdout=fd)
+        return new_path
+
+    def cleanup(self, force=False):
+        now = time.time()
+        if not force and now - self.last_cleanup < self.cleanup_interval:
+            return
+        self.last_cleanup = now
+        for d in os.listdir(self.scratch_directory):
+            path = os.path.join(self.scratch_directory, d)
+            try:
+                if now - os.stat(path).st_mtime > self.scratch_max_age:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                continue
+        entries = []
+        total = 0
+        for f in os.listdir(self.directory):
+            path = os.path.join(self.directory, f)
+            if f.endswith('.tmp') or not os.path.isfile(path):
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if now - st.st_mtime > self.max_age:
+                self.remove(path)
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            self.remove(path)
+            total -= size
+
+    def remove(self, path):
+        # another process may be cleaning up too
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+subtitles_store = SubtitlesStore()
+
+
+def compose_ass(primary, secondary, offset=0):
+    """Returns the path of an ASS file with the lines of two SubtitlesFiles,
+    the secondary ones at the top of the screen.
+
+    The files are kept in the subtitles store, one per pair of subtitles and
+    offset."""
+    name = '{p}_{s}_{o}.ass'.format(p=primary.id, s=secondary.id, o=offset)
+    path = subtitles_store.get(name)
+    if path:
+        return path
+    events = []
+    for style, subtitles_file in [('Default', primary), ('Top', secondary)]:
+        for start, end, text in get_cues(subtitles_file, offset, True):
+            events.append((start, end, style, to_ass_text(text)))
+    events.sort()
+    scratch = subtitles_store.make_scratch_directory()
+    try:
+        temp_path = os.path.join(scratch, name)
+        with io.open(temp_path, 'w', encoding='utf-8') as fd:
+            fd.write(ASS_HEADER)
+            for start, end, style, text in events:
+                fd.write('Dialogue: 0,{s},{e},{st},,0,0,0,,{t}\n'.format(
+                    s=format_ass_time(start), e=format_ass_time(end),
+                    st=style, t=text))
+        return subtitles_store.publish(temp_path, name)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
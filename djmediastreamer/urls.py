@@ -18,6 +18,24 @@ urlpatterns = [
     url(r'^get/(?P<id>[0-9]+)/$',
         views.GethMediaFileView.as_view(),
         name='get_mediafile'),
+    url(r'^subtitles/(?P<id>[0-9]+)\.vtt$',
+        views.SubtitlesVTTView.as_view(),
+        name='subtitles_vtt'),
+    url(r'^hls/(?P<id>[0-9]+)/index\.m3u8$',
+        views.HLSPlaylistView.as_view(),
+        name='hls_playlist'),
+    url(r'^hls/(?P<id>[0-9]+)/(?P<number>[0-9]+)\.ts$',
+        views.HLSSegmentView.as_view(),
+        name='hls_segment'),
+    url(r'^hls/(?P<id>[0-9]+)/master\.m3u8$',
+        views.HLSMasterPlaylistView.as_view(),
+        name='hls_master'),
+    url(r'^hls/(?P<id>[0-9]+)/(?P<rendition>[\w-]+)/index\.m3u8$',
+        views.HLSPlaylistView.as_view(),
+        name='hls_rendition_playlist'),
+    url(r'^hls/(?P<id>[0-9]+)/(?P<rendition>[\w-]+)/(?P<number>[0-9]+)\.ts$',
+        views.HLSSegmentView.as_view(),
+        name='hls_rendition_segment'),
     url(r'^collect/(?P<id>[0-9]+)/$',
         views.CollectDirectoryView.as_view(),
         name='collect'),
@@ -27,6 +45,18 @@ urlpatterns = [
     url(r'^stats/query/$',
         permission_required('is_staff')(views.QueryMediaFilesView.as_view()),
         name='query_mediafiles'),
+    url(r'^jobs/$',
+        views.TranscodeJobsView.as_view(),
+        name='transcode_jobs'),
+    url(r'^jobs/(?P<id>[0-9]+)/$',
+        views.TranscodeJobsView.as_view(),
+        name='transcode_job'),
+    url(r'^device/profile/$',
+        views.DeviceProfileView.as_view(),
+        name='device_profile'),
+    url(r'^stats/streams/$',
+        permission_required('is_staff')(views.StreamStatsView.as_view()),
+        name='stream_stats'),
     url(r'^login/$', views.LoginView.as_view(), name='login'),
     url(r'^logout/$', views.LogoutView.as_view(), name='logout'),
     url(r'^subtitles/$', views.SubtitlesView.as_view(), name='subtitles'),
@@ -3,9 +3,10 @@ import json
 import decimal
 import subprocess
 
+from django.conf import settings
 from django.db import connection
 
-from .models import Directory, MediaFile, SubtitlesFile
+from .models import Directory, MediaFile, SubtitlesFile, UserSettings
 
 
 def is_int(string):
@@ -35,7 +36,7 @@ def can_access_mediafile(user, mediafile):
 
 
 def str_duration_to_seconds(duration, mediafile):
-    'Converts a duration (HH:MM:SS or N%) to seconds.'
+    'Converts a duration (HH:MM:SS[.mmm] or N%) to seconds.'
     duration = duration.strip()
     if duration.endswith('%'):
         p = float(duration[:-1]) / 100
@@ -44,10 +45,29 @@ def str_duration_to_seconds(duration, mediafile):
         split = duration.split(':')
         s = int(split[0]) * 3600
         s += int(split[1]) * 60
-        s += int(split[2])
+        seconds = float(split[2])
+        s += int(seconds) if seconds.is_integer() else seconds
         return s
 
 
+def format_time(seconds):
+    'Returns seconds as HH:MM:SS.mmm'
+    ms = int(round(seconds * 1000))
+    return '{h:02d}:{m:02d}:{s:02d}.{ms:03d}'.format(
+        h=ms // 3600000, m=ms // 60000 % 60, s=ms // 1000 % 60, ms=ms % 1000)
+
+
+def get_log_position(mediafile_log, mediafile):
+    'Returns the last watched position (in seconds) of a MediaFileLog.'
+    position = mediafile_log.last_position or 0
+    params = mediafile_log.request_params or {}
+    if params.get('mode') == 'hls':
+        # the segmented player reports positions from the start of the file
+        return position
+    return str_duration_to_seconds(
+        params.get('goto', '00:00:00'), mediafile) + position
+
+
 def get_subtitles_from_request(request):
     # TODO: add doc
     subtitles = []
@@ -60,6 +80,19 @@ def get_subtitles_from_request(request):
     return subtitles, url
 
 
+def get_transcode_settings(user, mediafile):
+    'Returns the (width, height, vp8_crf) to use when transcoding for a user.'
+    width = None
+    height = None
+    vp8_crf = settings.DEFAULT_VP8_CRF
+    if UserSettings.objects.filter(user=user):
+        max_width = user.settings.max_width if user.settings else None
+        width = max_width if mediafile.width > max_width else None
+        height = mediafile.height * width / mediafile.width if width else None
+        vp8_crf = user.settings.vp8_crf or settings.DEFAULT_VP8_CRF
+    return width, height, vp8_crf
+
+
 def execute_query(sql, params=[]):
     cursor = connection.cursor()
     cursor.execute(sql, params)
@@ -114,14 +147,24 @@ def get_video_codecs():
     return get_distinct_field('v_codec')
 
 
+def with_timeout(cmd, timeout=None):
+    'Prefixes a command with coreutils timeout, it is killed after timeout.'
+    if not timeout:
+        return cmd
+    return ['timeout', '-s', 'KILL', str(timeout)] + cmd
+
+
 class MediaInfo(object):
-    def __init__(self, file_path):
-        self.minfo_output = subprocess.check_output(['mediainfo', file_path])
+    def __init__(self, file_path, timeout=None):
+        self.minfo_output = subprocess.check_output(
+            with_timeout(['mediainfo', file_path], timeout))
+        # split once, every getter searches in the lines
+        self.lines = self.minfo_output.split('\n')
         self.file_path = file_path
 
     def search(self, query, lines=None, lower=False):
         if not lines:
-            lines = self.minfo_output.split('\n')
+            lines = self.lines
         for i, l in enumerate(lines):
             if lower:
                 l = l.lower()
@@ -145,7 +188,7 @@ class MediaInfo(object):
     def _get_codec(self, codec_type):
         i, _ = self.search(codec_type, lower=True)
         if i >= 0:
-            lines = self.minfo_output.split('\n')[i:]
+            lines = self.lines[i:]
             _, f = self.search('Format', lines=lines)
             if f:
                 return f
@@ -175,11 +218,22 @@ class MediaInfo(object):
     def get_duration(self):
         i, _ = self.search('video', lower=True)
         if i >= 0:
-            lines = self.minfo_output.split('\n')[i:]
+            lines = self.lines[i:]
             _, str_d = self.search('Duration', lines=lines)
             d = self.parse_duration(str_d)
             return d
 
+    def get_fields(self):
+        'Returns the values of the MediaFile fields that come from mediainfo.'
+        width, height = self.get_size()
+        return {
+            'width': width,
+            'height': height,
+            'v_codec': self.get_video_codec(),
+            'a_codec': self.get_audio_codec(),
+            'duration': self.get_duration(),
+        }
+
     def get_mkv_subtitles_index(self):
         output = subprocess.check_output(['mkvinfo', self.file_path])
         lines = output.splitlines()
@@ -1,37 +1,63 @@
 import os
+import json
 import time
 import datetime
 import subprocess
+import multiprocessing
 from collections import OrderedDict
 
-import enzyme
-from sendfile import sendfile
 from django.db.models import Q
 from django.urls import reverse
 from django.conf import settings
 from django.core import management
 from background_task import background
-from django.core.management import call_command
 from django.views.generic import TemplateView, View
 from django.shortcuts import render, get_object_or_404
 from django.contrib.postgres.search import SearchQuery
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth import login, logout, authenticate
+from django.contrib.auth.models import User
 from django.http import (
-    HttpResponseRedirect, HttpResponseForbidden, JsonResponse,
-    StreamingHttpResponse
+    HttpResponse, HttpResponseRedirect, HttpResponseForbidden, JsonResponse,
+    StreamingHttpResponse, Http404
 )
 
 
 from .forms import StatisticsFiltersForm, SearchSubtitlesForm
 from .models import (
-    MediaFile, Directory, MediaFileLog, UserSettings, SubtitlesFile,
-    SubtitlesLine, TranscodeLog
+    MediaFile, Directory, MediaFileLog, SubtitlesFile, SubtitlesLine,
+    TranscodeLog, EncoderDowngrade, TranscodeJob
 )
 from .utils import (
     MediaInfo, get_allowed_directories, can_access_directory,
     can_access_mediafile, get_subtitles_from_request, plot_query,
-    str_duration_to_seconds, execute_query
+    str_duration_to_seconds, execute_query, get_transcode_settings,
+    get_log_position, format_time
+)
+from . import hls
+from . import jobs
+from .jobs import JobProgress
+from .cache import transcode_cache
+from .fileserve import serve_file, get_content_disposition
+from .async_stream import get_async_stream_url
+from .broker import transcode_broker
+from .scheduler import transcode_scheduler, NoTranscodeSlot
+from .chunked import ChunkedTranscode, split_ranges
+from .keyframes import get_keyframes, build_keyframe_index, snap_goto
+from .subtitles import (
+    render_webvtt, get_srclang, compose_ass, subtitles_store
+)
+from .playback import DIRECT, TRANSCODE, choose_playback
+from .prewarm import (
+    get_next_mediafile, get_prewarm_segments, has_budget, should_prewarm
+)
+from .devices import (
+    get_device_profile, get_capabilities, needs_probe, get_probe_types,
+    save_device_profile, set_device_cookie
+)
+from .streaming import CachingStream, TranscodeStream, stream_stats
+from .pacing import (
+    LIVE, BULK, PacedStream, get_stream_rate, stream_pacer
 )
 
 
@@ -105,13 +131,7 @@ class MediaFilesView(LoginRequiredMixin, TemplateView):
             ).order_by('-dtm')
             if mfls:
                 mlf = mfls.first()
-                time_zero = time.mktime(time.strptime('00:00:00', '%H:%M:%S'))
-                goto = mlf.request_params.get('goto', '00:00:00')
-                if goto.endswith('%'):
-                    seconds = str_duration_to_seconds(goto, mf)
-                    goto = MediaFile(duration=seconds).str_duration
-                initial = time.mktime(time.strptime(goto, '%H:%M:%S'))
-                new_initial = initial - time_zero + mlf.last_position
+                new_initial = get_log_position(mlf, mf)
                 mf.last_position = MediaFile(duration=new_initial).str_duration
                 mf.progress = int(1.0*new_initial / mf.duration * 100)
         context['mediafiles'] = mfs
@@ -133,17 +153,23 @@ class WatchMediaFileView(LoginRequiredMixin, TemplateView):
         if not can_access_mediafile(request.user, mf):
             return HttpResponseForbidden()
         mf.url = reverse('get_mediafile', args=(mf.id,))
-        goto = request.GET.get('goto')
+        request_params = dict(request.GET.items())
+        goto = snap_goto(mf, request.GET.get('goto'))
         if goto:
+            # where the video really starts, so the positions don't drift
+            request_params['goto'] = goto
             mf.url += '?goto={g}'.format(g=goto)
             # escape percentage symbol
             if goto.endswith('%'):
                 mf.url += '25'
 
         selected_subs, url_append = get_subtitles_from_request(request)
-        mf.url += url_append
-        mf.transcoded_url = mf.url
-        mf.generate_transcoded_url = mf.url
+        # text tracks are shown by the player instead of burned in the video
+        text_tracks = request.GET.get('subs_mode') == 'track'
+        mf.transcoded_url = mf.url + url_append
+        mf.generate_transcoded_url = mf.transcoded_url
+        if not text_tracks:
+            mf.url += url_append
         trnscoded_append = 'download=true'
         if '?' in mf.transcoded_url:
             mf.transcoded_url += '&' + trnscoded_append
@@ -151,16 +177,40 @@ class WatchMediaFileView(LoginRequiredMixin, TemplateView):
         else:
             mf.transcoded_url += '?' + trnscoded_append
             mf.generate_transcoded_url += '?' + 'generate_file=true'
-        mf.video_type = 'video/webm'
-
-        if mf.extension == 'mp4' and mf.v_codec == 'AVC':
-            mf.video_type = 'video/mp4'
+        profile = get_device_profile(request)
+        context['probe_device'] = needs_probe(request, profile)
+        context['device_probes'] = json.dumps(get_probe_types())
+        mf.video_type = choose_playback(
+            mf, get_capabilities(request, profile), goto,
+            None if text_tracks else selected_subs
+        ).mimetype
         context['mediafile'] = mf
         progress = 0
+        start_position = 0
         if goto:
-            s = str_duration_to_seconds(goto, mf)
-            progress = int((s*1.0 / mf.duration) * 100)
+            start_position = str_duration_to_seconds(goto, mf)
+            progress = int((start_position*1.0 / mf.duration) * 100)
         context['progress'] = progress
+        context['hls'] = request.GET.get('mode') == 'hls' and bool(
+            mf.duration)
+        if context['hls']:
+            # the whole file is in the playlist, the player does the seek
+            playlist = 'hls_master' if settings.RENDITIONS else 'hls_playlist'
+            context['hls_url'] = reverse(playlist, args=(mf.id,)) + \
+                hls.get_query_string(request, not text_tracks)
+            context['start_position'] = start_position
+        context['text_tracks'] = text_tracks
+        context['tracks'] = []
+        if text_tracks:
+            # the hls playlist starts at the beginning of the file
+            offset = 0 if context['hls'] else start_position
+            for s in selected_subs:
+                context['tracks'].append({
+                    'url': '{u}?offset={o}'.format(
+                        u=reverse('subtitles_vtt', args=(s.id,)), o=offset),
+                    'label': s.language,
+                    'srclang': get_srclang(s.language),
+                })
 
         subtitles_avail = self.lookfor_subtitles(mf)
         subtitles = []
@@ -181,10 +231,11 @@ class WatchMediaFileView(LoginRequiredMixin, TemplateView):
             mediafile=mf,
             user=request.user,
             request=request.path,
-            request_params=request.GET,
+            request_params=request_params,
             ip=request.META.get('HTTP_X_REAL_IP', request.META['REMOTE_ADDR'])
         )
-        return render(request, self.template_name, context)
+        return set_device_cookie(
+            request, render(request, self.template_name, context))
 
     def put(self, request, id, *args, **kwargs):
         mf = get_object_or_404(MediaFile, id=id)
@@ -194,6 +245,7 @@ class WatchMediaFileView(LoginRequiredMixin, TemplateView):
             mediafile=mf, user=request.user
         ).order_by('-dtm')
         mfl = mfls.first()
+        old_position = get_log_position(mfl, mf)
         split = request.body.split('=')
         position = float(split[1])
         mfl.last_position = int(position)
@@ -201,16 +253,19 @@ class WatchMediaFileView(LoginRequiredMixin, TemplateView):
             'HTTP_X_REAL_IP', request.META['REMOTE_ADDR']
         )
         mfl.save()
-        initial = str_duration_to_seconds(
-            mfl.request_params.get('goto', '00:00:00'), mf
-        )
-        progress = int(1.0*(initial + mfl.last_position) / mf.duration * 100)
+        new_position = get_log_position(mfl, mf)
+        if should_prewarm(mf, old_position, new_position):
+            jobs.submit(prewarm_next, jobs.PREWARM,
+                        [mf.id, request.user.id], mf, request.user,
+                        mediafile_id=mf.id, user_id=request.user.id)
+        progress = int(1.0*new_position / mf.duration * 100)
         return JsonResponse({'progress': progress})
 
 
-def get_pipe(cmd):
+def get_pipe(cmd, slot=None):
+        kwargs = slot.popen_kwargs() if slot else {}
         return subprocess.Popen(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs
         )
 
 
@@ -225,18 +280,146 @@ def get_str_cmd(cmd_lst):
     return ' '.join(params)
 
 
+def transcode_slots_busy():
+    res = HttpResponse(
+        'All the transcoding slots are busy, try again later.\n',
+        content_type='text/plain', status=503
+    )
+    res['Retry-After'] = str(settings.TRANSCODE_QUEUE_TIMEOUT)
+    return res
+
+
 @background(schedule=1)
-def transcode_to_file(full_path, subtitle_ids, goto, user_id, mediafile_id):
-    split = full_path.split('.')
-    new_file = '.'.join(split[:-1]) + '_transcoded.' + split[-1]
-    subtitles = SubtitlesFile.objects.filter(id__in=subtitle_ids)
+@jobs.reports_failure
+def transcode_to_file(full_path, subtitle_ids, goto, user_id, mediafile_id,
+                      output_format='matroska', width=None, height=None,
+                      vp8_crf=None, job_id=None):
+    progress = JobProgress(job_id)
+    progress.start()
+    mf = MediaFile.objects.get(id=mediafile_id)
+    subtitles = [SubtitlesFile.objects.get(id=i) for i in subtitle_ids]
+    key = transcode_cache.get_key(mf, subtitles, goto, output_format, width,
+                                  vp8_crf)
+    if transcode_cache.get(key, output_format):
+        progress.finish()
+        return
+    new_file = transcode_cache.get_path(key, output_format)
+    temp_file = transcode_cache.get_temp_path(new_file)
     view = GethMediaFileView()
-    cmd = view.get_transcode_cmd(full_path, subtitles, goto, 'matroska',
-                                 output_file=new_file)
+    cmd = view.get_transcode_cmd(full_path, subtitles, goto, output_format,
+                                 width, height, vp8_crf or 24,
+                                 output_file=temp_file)
     TranscodeLog.objects.create(mediafile_id=mediafile_id,
                                 user_id=user_id,
                                 command=get_str_cmd(cmd))
-    subprocess.call(cmd)
+    start = str_duration_to_seconds(goto, mf) if goto else 0
+    if settings.CHUNKED_ENCODING and mf.duration and \
+            mf.duration - start > 2 * settings.CHUNK_MIN_DURATION:
+        done = transcode_in_chunks(view, mf, key, subtitles, start,
+                                   output_format, width, height,
+                                   vp8_crf or 24, temp_file,
+                                   on_progress=progress.update)
+    else:
+        stream = TranscodeStream(get_pipe(cmd))
+        while stream.process.poll() is None:
+            time.sleep(5)
+            if mf.duration and mf.duration > start:
+                progress.update(100.0 * stream.progress.get('time', 0) /
+                                (mf.duration - start))
+        done = stream.wait() == 0
+    if done:
+        transcode_cache.put(temp_file, new_file)
+    else:
+        transcode_cache.discard(temp_file)
+    progress.finish(done)
+
+
+@background(schedule=1)
+@jobs.reports_failure
+def prewarm_next(mediafile_id, user_id, job_id=None):
+    """Encodes the first segments of the file after mediafile_id, the ones
+    the user would get when starting it with segmented streaming."""
+    progress = JobProgress(job_id)
+    progress.start()
+    mf = get_next_mediafile(MediaFile.objects.get(id=mediafile_id))
+    if not mf or not mf.duration:
+        progress.finish()
+        return
+    user = User.objects.get(id=user_id)
+    width, height, crf = get_transcode_settings(user, mf)
+    if settings.RENDITIONS:
+        # the player starts with the first rendition of the master playlist
+        rendition = hls.get_renditions(mf, width)[0]
+        width, height = hls.get_rendition_size(mf, rendition)
+        crf = rendition['crf']
+    key = hls.get_segments_key(mf, None, width, height, crf)
+    view = HLSSegmentView()
+    segments = get_prewarm_segments(mf)
+    for i, number in enumerate(segments):
+        progress.update(100.0 * i / len(segments))
+        segment_path = hls.get_segment_path(key, number)
+        if os.path.exists(segment_path):
+            continue
+        if not has_budget():
+            break
+        slot = transcode_scheduler.try_acquire()
+        if slot is None:
+            break
+        try:
+            stream = view.encode_segment(mf, number, segment_path, None,
+                                         width, height, crf, slot,
+                                         cmd_prefix=['nice', '-n', '19'])
+        finally:
+            slot.release()
+        if stream is None:
+            progress.finish(False)
+            return
+    # out of budget is not a failure, what is missing is encoded on demand
+    progress.finish()
+
+
+def transcode_in_chunks(view, mf, key, subtitles, start, output_format,
+                        width, height, vp8_crf, output_file,
+                        on_progress=None):
+    """Encodes [start, duration) of the mediafile in parallel chunks that are
+    cut at keyframes and joins them in output_file.
+
+    The chunks are kept in settings.CHUNKS_DIR until they are joined, so an
+    interrupted job continues where it was. Every ffmpeg takes a transcode
+    slot and runs niced, like prewarm_next. The chunks only have video when
+    the file has a known audio track, that is encoded once."""
+    workers = settings.CHUNKED_ENCODING_WORKERS or multiprocessing.cpu_count()
+    keyframes = get_keyframes(mf) or build_keyframe_index(mf)
+    ranges = split_ranges(keyframes, start, mf.duration, workers * 2)
+    separate_audio = bool(mf.a_codec)
+    chunked = ChunkedTranscode(
+        os.path.join(settings.CHUNKS_DIR, key), ranges,
+        transcode_cache.extensions.get(output_format, output_format),
+        separate_audio)
+
+    def get_cmd(chunk_start, duration, chunk_file, threads):
+        return view.get_transcode_cmd(
+            mf.full_path, subtitles, format_time(chunk_start), output_format,
+            width, height, vp8_crf, output_file=chunk_file, threads=threads,
+            duration=duration, audio=not separate_audio)
+
+    def get_audio_cmd(audio_file):
+        cmd = ['ffmpeg']
+        if start:
+            cmd.extend(['-ss', format_time(start)])
+        cmd.extend([
+            '-i', mf.full_path, '-vn', '-sn', '-threads', '1', '-y',
+            '-f', output_format, audio_file
+        ])
+        return cmd
+
+    if not chunked.run(get_cmd, workers, on_progress, get_audio_cmd,
+                       transcode_scheduler, ['nice', '-n', '19']):
+        return False
+    if not chunked.concat(output_format, output_file):
+        return False
+    chunked.remove()
+    return True
 
 
 class GethMediaFileView(LoginRequiredMixin, View):
@@ -244,105 +427,110 @@ class GethMediaFileView(LoginRequiredMixin, View):
     redirect_field_name = 'next'
 
     def prepare_subtitles(self, s, offset=None, keep_on_screen=False):
-        if s.is_internal and not keep_on_screen:
-            full_path = os.path.join(s.directory, s.file_name)
-            with open(full_path, 'rb') as fd:
-                mkv = enzyme.MKV(fd)
-                # TODO: check which track number instead of iterate
-                for sub_track in mkv.subtitle_tracks:
-                    sub_track = mkv.subtitle_tracks[0]
-                    if sub_track.codec_id == 'S_TEXT/UTF8':
-                        new_file = 'subtitle_{id}.srt'.format(id=s.id)
-                        cmd = ['mkvextract', 'tracks', full_path,
-                               '{n}:{e}'.format(
-                                n=sub_track.number - 1, e=new_file)]
-                        subprocess.check_output(cmd)
-                        subtitle_path = new_file
-                        break
-        if not s.is_internal:
-            subtitle_path = os.path.join(s.directory, s.file_name)
-        if keep_on_screen:
-            subtitle_path = '{id}_keep.srt'.format(id=s.id)
-            call_command('export_subtitles', s.id, subtitle_path, True)
-        res = subtitle_path
-        output = subprocess.check_output(['file', subtitle_path])
-        cmd = None
-        extension = s.extension if s.extension != 'mkv' else 'srt'
-        new_name = '{id}.utf8.{ext}'.format(id=s.id, ext=extension)
-        if 'ISO-8859' in output or 'Non-ISO extended-ASCII' in output:
-            cmd = 'iconv --from-code=ISO-8859-1 --to-code=UTF-8 "{s}" > "{n}"'\
-                .format(s=subtitle_path, n=new_name)
-        elif 'ASCII' in output:
-            cmd = 'iconv --from-code=ASCII --to-code=UTF-8 "{s}" > "{n}"'\
-                .format(s=subtitle_path, n=new_name)
-        if cmd:
-            os.system(cmd)
-            res = new_name
-        if offset:
-            split = new_name.split('.')
-            n = '.'.join(split[:-1])
-            new_name = '{n}.ss.{ext}'.format(n=n, ext=split[-1])
-            cmd = 'ffmpeg -i "{res}" -ss {offset} -f {ext} -y "{nn}"'.format(
-                res=res, offset=offset, ext=split[-1], nn=new_name
-            )
-            os.system(cmd)
-            res = new_name
-        return res
-
+        return subtitles_store.prepare(s, offset, keep_on_screen)
 
     def get_transcode_cmd(self, full_path, subtitles=None, goto=None,
                           output_format='webm', width=None, height=None,
-                          vp8_crf=24, output_file='-'):
+                          vp8_crf=24, output_file='-', threads=None,
+                          duration=None, audio=True):
+        threads = str(threads or transcode_scheduler.get_threads())
         if output_format == 'webm':
             cmd = ['ffmpeg', '-i', full_path]
             if width:
                 cmd.extend(['-s',  '{mw}x{h}'.format(mw=width, h=height)])
             cmd.extend([
                 '-codec:v', 'vp8', '-b:v', '0', '-crf', str(vp8_crf),
-                '-threads', '8', '-speed', '4'
+                '-threads', threads, '-speed', '4'
             ])
 
             extend = ['-y', '-f', 'webm', output_file]
         elif output_format == 'matroska':
             cmd = [
                 'ffmpeg', '-i', full_path,
-                '-crf', '18', '-y'
+                '-crf', '18', '-threads', threads, '-y'
             ]
             extend = ['-f', 'matroska', output_file]
+        if duration:
+            cmd.insert(1, '-t')
+            cmd.insert(2, str(duration))
         if goto:
             cmd.insert(1, '-ss')
             cmd.insert(2, goto)
-        prepared_subtitles = []
-        if subtitles:
-            keep_on_screen = len(subtitles) > 1
-            for i, s in enumerate(subtitles):
-                prepared_subtitles.append(
-                    self.prepare_subtitles(s, goto, keep_on_screen))
-            if len(prepared_subtitles) == 1:
-                cmd.extend(['-vf', 'subtitles={s}'.format(
-                    s=prepared_subtitles[0])])
-            else:
-                subs_out = '.'.join(full_path.split('.')[:-1]) + '__.ass'
-                venv_cmd = ''
-                if settings.VIRTUAL_ENV_PATH:
-                    venv_cmd = 'source {path}/bin/activate;'.format(
-                        path=settings.VIRTUAL_ENV_PATH)
-                subtitles_cmd = '{venv_cmd} ffmpeg -i "{s1}" -f ass - | ./manage.py move_subs_to_top > "{out}"'.format(
-                    venv_cmd=venv_cmd, s1=prepared_subtitles[1], out=subs_out)
-                subtitles_cmd = 'bash -c "{cmd}"'.format(cmd=subtitles_cmd.replace('"', r'\"'))
-                os.system(subtitles_cmd)
-                cmd.extend(['-vf', 'subtitles={s0},ass={s1}'.format(
-                    s0=prepared_subtitles[0], s1=subs_out)]
-                )
+        subtitles_filter = self.get_subtitles_filter(
+            full_path, subtitles, goto)
+        if subtitles_filter:
+            cmd.extend(['-vf', subtitles_filter])
+        if not audio:
+            cmd.append('-an')
         cmd.extend(extend)
         return cmd
 
+    def get_subtitles_filter(self, full_path, subtitles=None, goto=None):
+        """Returns the ffmpeg video filter that burns the subtitles in, or None
+        if there are no subtitles."""
+        if not subtitles:
+            return None
+        if len(subtitles) == 1:
+            return 'subtitles={s}'.format(
+                s=self.prepare_subtitles(subtitles[0], goto))
+        # the second subtitles go to the top of the screen
+        offset = str_duration_to_seconds(goto, None) if goto else 0
+        return 'ass={s}'.format(
+            s=compose_ass(subtitles[0], subtitles[1], offset))
+
+    def get_segment_cmd(self, full_path, start, duration, output_file,
+                        subtitles=None, width=None, height=None, crf=23,
+                        threads=None, preset='veryfast'):
+        """Returns the command that encodes one HLS segment (H.264/AAC in
+        MPEG-TS).
+
+        The original timestamps are kept (-copyts) so the segments can be
+        played one after the other and the subtitles don't need an offset."""
+        cmd = [
+            'ffmpeg', '-ss', str(start), '-t', str(duration), '-copyts',
+            '-i', full_path
+        ]
+        if width:
+            cmd.extend(['-s', '{mw}x{h}'.format(mw=width, h=height)])
+        subtitles_filter = hls.get_subtitles_filter(
+            full_path, subtitles, self.get_subtitles_filter)
+        if subtitles_filter:
+            cmd.extend(['-vf', subtitles_filter])
+        cmd.extend([
+            '-map', '0:v:0', '-map', '0:a:0?',
+            '-codec:v', 'libx264', '-preset', preset, '-crf', str(crf),
+            '-codec:a', 'aac', '-ac', '2', '-b:a', '128k',
+            '-threads', str(threads or transcode_scheduler.get_threads()),
+            '-muxdelay', '0',
+            '-y', '-f', 'mpegts', output_file
+        ])
+        return cmd
+
+    def get_remux_cmd(self, full_path, goto=None, output_format='mp4',
+                      audio_codec='copy', output_file='-'):
+        """Returns the command that copies the video (and the audio, unless
+        audio_codec is given) into a container the client can play."""
+        cmd = ['ffmpeg']
+        if goto:
+            cmd.extend(['-ss', goto])
+        cmd.extend([
+            '-i', full_path, '-map', '0:v:0', '-map', '0:a:0?',
+            '-codec:v', 'copy', '-codec:a', audio_codec
+        ])
+        if audio_codec != 'copy':
+            cmd.extend(['-ac', '2', '-b:a', '128k'])
+        if output_format == 'mp4':
+            # a pipe can't be seeked back to write the moov atom
+            cmd.extend(['-movflags', 'frag_keyframe+empty_moov'])
+        cmd.extend(['-y', '-f', output_format, output_file])
+        return cmd
+
     def transcode_process(self, full_path, subtitles=None, goto=None,
                           output_format='webm', width=None, height=None,
-                          vp8_crf=24):
+                          vp8_crf=24, slot=None):
         return get_pipe(self.get_transcode_cmd(full_path, subtitles, goto,
                                                output_format, width, height,
-                                               vp8_crf))
+                                               vp8_crf), slot)
 
     def get(self, request, id, *args, **kwargs):
         mf = get_object_or_404(MediaFile, id=id)
@@ -353,50 +541,306 @@ class GethMediaFileView(LoginRequiredMixin, View):
         if goto and goto.endswith('%'):
             seconds = str_duration_to_seconds(goto, mf)
             goto = MediaFile(duration=seconds).str_duration
-        if mf.extension == 'mp4' and mf.v_codec == 'AVC' and (
-            (not goto) and (not subtitles)
-        ):
-            return sendfile(request, mf.full_path)
-        else:
-            fn = '.'.join(mf.file_name.split('.')[:-1])
-            output_format = 'webm'
-            if 'Chrome' in request.META['HTTP_USER_AGENT'] and (
-                'Android' not in request.META['HTTP_USER_AGENT']
-            ):
+        playback = choose_playback(
+            mf, get_capabilities(request), goto, subtitles)
+        if playback.mode == DIRECT:
+            rate, burst = get_stream_rate(mf)
+            return serve_file(request, mf.full_path, playback.mimetype,
+                              kind=LIVE, rate=rate, burst=burst)
+        fn = '.'.join(mf.file_name.split('.')[:-1]) + '.' + playback.extension
+        output_format = playback.container
+        width, height, vp8_crf = get_transcode_settings(request.user, mf)
+        download = request.GET.get('download') == 'true'
+        if request.GET.get('generate_file') == 'true':
+            if playback.mode != TRANSCODE:
                 output_format = 'matroska'
-                fn += '.mkv'
+            jobs.submit(
+                transcode_to_file, jobs.GENERATE,
+                transcode_cache.get_key(mf, subtitles, goto, output_format,
+                                        width, vp8_crf),
+                mf, request.user,
+                full_path=mf.full_path,
+                subtitle_ids=[s.id for s in subtitles], goto=goto,
+                user_id=request.user.id, mediafile_id=mf.id,
+                output_format=output_format, width=width, height=height,
+                vp8_crf=vp8_crf)
+            return HttpResponseRedirect(reverse('directories'))
+        if playback.mode == TRANSCODE:
+            key = transcode_cache.get_key(mf, subtitles, goto, output_format,
+                                          width, vp8_crf)
+        else:
+            key = transcode_cache.get_key(mf, None, goto, output_format,
+                                          mode=playback.mode)
+        cached_file = transcode_cache.get(key, output_format)
+        if cached_file:
+            if download:
+                rate, burst = settings.DOWNLOAD_MAX_RATE, None
             else:
-                fn += '.webm'
-            width = None
-            height = None
-            vp8_crf = settings.DEFAULT_VP8_CRF
-            if UserSettings.objects.filter(user=request.user):
-                max_width = request.user.settings.max_width \
-                    if request.user.settings else None
-                width = max_width if mf.width > max_width else None
-                height = mf.height * width / mf.width if width else None
-                vp8_crf = request.user.settings.vp8_crf or (
-                    settings.DEFAULT_VP8_CRF
-                )
-            if request.GET.get('generate_file') == 'true':
-                # TODO: use the background task
-                transcode_to_file(full_path=mf.full_path,
-                                  subtitle_ids=[s.id for s in subtitles],
-                                  goto=goto, user_id=request.user.id,
-                                  mediafile_id=mf.id)
-                return HttpResponseRedirect(reverse('directories'))
-            res = StreamingHttpResponse(
-                self.transcode_process(
-                    mf.full_path, subtitles, goto, output_format, width,
-                    height, vp8_crf
-                ).stdout,
-                content_type='video/webm',
-            )
-            res['Content-Disposition'] = 'filename="{fn}"'.format(fn=fn)
-            if request.GET.get('download') == 'true':
-                res['Content-Disposition'] = 'attachment; {cd}'.format(
-                    cd=res['Content-Disposition'])
-            return res
+                # the bitrate of the transcode, not the one of the original
+                rate, burst = get_stream_rate(
+                    mf, os.path.getsize(cached_file),
+                    str_duration_to_seconds(goto, mf) if goto else 0)
+            return serve_file(request, cached_file, playback.mimetype,
+                              attachment=download, attachment_filename=fn,
+                              kind=BULK if download else LIVE, rate=rate,
+                              burst=burst)
+        stream = transcode_broker.join(key)
+        if stream is None and settings.ASYNC_STREAM_URL:
+            # the stream server's event loop sends it, not this worker
+            params = {'input': mf.full_path, 'goto': goto,
+                      'output_format': output_format}
+            if playback.mode == TRANSCODE:
+                params.update({
+                    'mode': 'transcode', 'width': width, 'height': height,
+                    'vp8_crf': vp8_crf,
+                    'threads': transcode_scheduler.get_threads(),
+                    'subtitles_filter': self.get_subtitles_filter(
+                        mf.full_path, subtitles, goto),
+                })
+            else:
+                params.update({'mode': 'remux',
+                               'audio_codec': playback.audio_codec})
+            return HttpResponseRedirect(get_async_stream_url(
+                params, playback.mimetype, fn, download,
+                transcode_cache.get_path(key, output_format),
+                use_slot=playback.mode == TRANSCODE))
+        if stream is None:
+            slot = None
+            if playback.mode == TRANSCODE:
+                try:
+                    slot = transcode_scheduler.acquire()
+                except NoTranscodeSlot:
+                    return transcode_slots_busy()
+
+            def start_transcode():
+                if playback.mode == TRANSCODE:
+                    process = self.transcode_process(
+                        mf.full_path, subtitles, goto, output_format, width,
+                        height, vp8_crf, slot
+                    )
+                else:
+                    # copying the streams barely uses CPU, it needs no slot
+                    process = get_pipe(self.get_remux_cmd(
+                        mf.full_path, goto, output_format,
+                        playback.audio_codec))
+                return CachingStream(
+                    TranscodeStream(process),
+                    transcode_cache.get_path(key, output_format))
+
+            try:
+                stream = transcode_broker.get_stream(key, start_transcode)
+            finally:
+                if slot:
+                    # ffmpeg keeps its own copy of the slot
+                    slot.release()
+        # a live transcode is not paced on its own (ffmpeg sends it at about
+        # real time and its bitrate is not the one of the original), it only
+        # takes its bytes from the shared bucket
+        rate = settings.DOWNLOAD_MAX_RATE if download else None
+        stream = PacedStream(stream, rate, None, BULK if download else LIVE)
+        res = StreamingHttpResponse(stream, content_type=playback.mimetype)
+        res['Content-Disposition'] = get_content_disposition(fn, download)
+        return res
+
+
+class SubtitlesVTTView(LoginRequiredMixin, View):
+    login_url = '/login/'
+    redirect_field_name = 'next'
+
+    def get(self, request, id, *args, **kwargs):
+        sf = get_object_or_404(SubtitlesFile, id=id)
+        # a SubtitlesFile has a directory too
+        if not can_access_mediafile(request.user, sf):
+            return HttpResponseForbidden()
+        try:
+            offset = float(request.GET.get('offset') or 0)
+        except ValueError:
+            return HttpResponse(status=400)
+        return HttpResponse(render_webvtt(sf, offset),
+                            content_type='text/vtt; charset=utf-8')
+
+
+class HLSMasterPlaylistView(LoginRequiredMixin, View):
+    """Returns the master playlist with the renditions of settings.RENDITIONS
+    that fit the mediafile and the user's max width."""
+    login_url = '/login/'
+    redirect_field_name = 'next'
+
+    def get(self, request, id, *args, **kwargs):
+        mf = get_object_or_404(MediaFile, id=id)
+        if not can_access_mediafile(request.user, mf):
+            return HttpResponseForbidden()
+        if not mf.duration:
+            raise Http404('Unknown duration.')
+        max_width, _, _ = get_transcode_settings(request.user, mf)
+        renditions = hls.get_renditions(mf, max_width)
+        if not renditions:
+            raise Http404('No renditions.')
+        query_string = hls.get_query_string(request)
+
+        def playlist_url(name):
+            return reverse('hls_rendition_playlist', args=(mf.id, name)) + \
+                query_string
+
+        return HttpResponse(
+            hls.render_master_playlist(mf, renditions, playlist_url),
+            content_type='application/vnd.apple.mpegurl'
+        )
+
+
+class HLSPlaylistView(LoginRequiredMixin, View):
+    login_url = '/login/'
+    redirect_field_name = 'next'
+
+    def get(self, request, id, rendition=None, *args, **kwargs):
+        mf = get_object_or_404(MediaFile, id=id)
+        if not can_access_mediafile(request.user, mf):
+            return HttpResponseForbidden()
+        if not mf.duration:
+            raise Http404('Unknown duration.')
+        if rendition:
+            max_width, _, _ = get_transcode_settings(request.user, mf)
+            if not hls.get_rendition(rendition, mf, max_width):
+                # only the ones of the master playlist of the user
+                raise Http404('Unknown rendition.')
+        query_string = hls.get_query_string(request)
+
+        def segment_url(n):
+            if rendition:
+                url = reverse('hls_rendition_segment',
+                              args=(mf.id, rendition, n))
+            else:
+                url = reverse('hls_segment', args=(mf.id, n))
+            return url + query_string
+
+        return HttpResponse(
+            hls.render_playlist(mf, segment_url),
+            content_type='application/vnd.apple.mpegurl'
+        )
+
+
+class HLSSegmentView(GethMediaFileView):
+    """Returns one segment of the mediafile.
+
+    Segments are encoded on demand and kept in settings.SEGMENTS_DIR, so
+    seeking or watching again only reads them from the disk.
+
+    With a rendition the size and crf come from settings.RENDITIONS, so
+    only the renditions (and parts) that are watched are ever encoded.
+
+    When a segment is encoded slower than settings.REALTIME_MIN_SPEED the
+    next ones of the session use a faster encoder level (see
+    settings.ENCODER_LEVELS) and the decision is saved as an
+    EncoderDowngrade."""
+
+    def find_segment(self, mf, subtitles, width, height, crf, number):
+        'Returns the path of the segment encoded at any level, if any.'
+        for level in range(len(settings.ENCODER_LEVELS)):
+            key = hls.get_segments_key(mf, subtitles, width, height, crf,
+                                       level)
+            segment_path = hls.get_segment_path(key, number, create=False)
+            if os.path.exists(segment_path):
+                return segment_path
+        return None
+
+    def encode_segment(self, mf, number, segment_path, subtitles, width,
+                       height, crf, slot, preset='veryfast', cmd_prefix=None):
+        """Encodes a segment into segment_path. Returns the finished
+        TranscodeStream or None if ffmpeg failed."""
+        start, duration = hls.get_segment_times(mf, number)
+        # write to a temporary file so nobody reads a half done segment
+        temp_path = '{p}.{pid}.tmp'.format(p=segment_path, pid=os.getpid())
+        cmd = self.get_segment_cmd(mf.full_path, start, duration, temp_path,
+                                   subtitles, width, height, crf,
+                                   preset=preset)
+        stream = TranscodeStream(get_pipe((cmd_prefix or []) + cmd, slot))
+        if stream.wait() != 0:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return None
+        transcode_cache.put(temp_path, segment_path)
+        return stream
+
+    def check_speed(self, request, mf, key, level, number, stream, elapsed):
+        """Moves the session to the next encoder level if the segment was
+        encoded too slow, and back to the previous one after
+        settings.REALTIME_RECOVER_SEGMENTS segments in a row encoded at
+        settings.REALTIME_RECOVER_SPEED or faster."""
+        _, duration = hls.get_segment_times(mf, number)
+        speed = stream.progress.get('speed')
+        if not speed and elapsed > 0:
+            speed = duration / elapsed
+        if not speed:
+            return
+        fast = request.session.get('encoder_fast_segments', {})
+        to_level = level
+        if speed < settings.REALTIME_MIN_SPEED:
+            fast[key] = 0
+            if level < len(settings.ENCODER_LEVELS) - 1:
+                to_level = level + 1
+        elif speed >= settings.REALTIME_RECOVER_SPEED and level > 0:
+            fast[key] = fast.get(key, 0) + 1
+            if fast[key] >= settings.REALTIME_RECOVER_SEGMENTS:
+                fast[key] = 0
+                to_level = level - 1
+        else:
+            fast[key] = 0
+        request.session['encoder_fast_segments'] = fast
+        if to_level == level:
+            return
+        EncoderDowngrade.objects.create(
+            mediafile=mf, user=request.user, segment=number, speed=speed,
+            fps=stream.progress.get('fps'), from_level=level,
+            to_level=to_level
+        )
+        levels = request.session.get('encoder_levels', {})
+        levels[key] = to_level
+        request.session['encoder_levels'] = levels
+
+    def get(self, request, id, number, rendition=None, *args, **kwargs):
+        mf = get_object_or_404(MediaFile, id=id)
+        if not can_access_mediafile(request.user, mf):
+            return HttpResponseForbidden()
+        number = int(number)
+        if not mf.duration or number >= hls.get_segments_count(mf):
+            raise Http404('Segment out of range.')
+        subtitles, _ = get_subtitles_from_request(request)
+        if rendition:
+            max_width, _, _ = get_transcode_settings(request.user, mf)
+            rendition = hls.get_rendition(rendition, mf, max_width)
+            if not rendition:
+                raise Http404('Unknown rendition.')
+            width, height = hls.get_rendition_size(mf, rendition)
+            crf = rendition['crf']
+        else:
+            width, height, crf = get_transcode_settings(request.user, mf)
+        segment_path = self.find_segment(mf, subtitles, width, height, crf,
+                                         number)
+        if segment_path:
+            transcode_cache.touch(segment_path)
+            return serve_file(request, segment_path, 'video/mp2t')
+        key = hls.get_segments_key(mf, subtitles, width, height, crf)
+        level = request.session.get('encoder_levels', {}).get(key, 0)
+        preset, level_width, level_height = hls.get_encoder_params(
+            level, mf, width, height)
+        segment_path = hls.get_segment_path(hls.get_segments_key(
+            mf, subtitles, width, height, crf, level), number)
+        try:
+            slot = transcode_scheduler.acquire()
+        except NoTranscodeSlot:
+            return transcode_slots_busy()
+        try:
+            started = time.time()
+            stream = self.encode_segment(mf, number, segment_path, subtitles,
+                                         level_width, level_height, crf,
+                                         slot, preset)
+            elapsed = time.time() - started
+        finally:
+            slot.release()
+        if stream is None:
+            return HttpResponse(status=500)
+        self.check_speed(request, mf, key, level, number, stream, elapsed)
+        return serve_file(request, segment_path, 'video/mp2t')
 
 
 class DownloadMediaFileView(LoginRequiredMixin, View):
@@ -413,7 +857,8 @@ class DownloadMediaFileView(LoginRequiredMixin, View):
             request=request.path,
             request_params=request.GET
         )
-        return sendfile(request, mf.full_path, attachment=True)
+        return serve_file(request, mf.full_path, attachment=True, kind=BULK,
+                          rate=settings.DOWNLOAD_MAX_RATE)
 
 
 class CollectDirectoryView(LoginRequiredMixin, View):
@@ -424,6 +869,8 @@ class CollectDirectoryView(LoginRequiredMixin, View):
         management.call_command(
             'collect_media',
             with_mediainfo=True,
+            # the index snap_goto moves the seeks with
+            with_keyframes=True,
             directory=d.path,
             remove_missing=True
         )
@@ -434,6 +881,50 @@ class CollectDirectoryView(LoginRequiredMixin, View):
         return HttpResponseRedirect(reverse('directories'))
 
 
+class DeviceProfileView(LoginRequiredMixin, View):
+    """Receives the canPlayType answers of the player (a json object of
+    type: answer) and stores them as the profile of the device."""
+
+    def post(self, request, *args, **kwargs):
+        try:
+            results = json.loads(request.body.decode('utf8'))
+        except ValueError:
+            return HttpResponse(status=400)
+        if not isinstance(results, dict):
+            return HttpResponse(status=400)
+        before = get_capabilities(request)
+        profile = save_device_profile(request, results)
+        if profile is None:
+            return HttpResponse(status=400)
+        changed = get_capabilities(request, profile) != before
+        return JsonResponse({'changed': changed})
+
+
+class TranscodeJobsView(LoginRequiredMixin, View):
+    """Returns the status and progress of a job, or the last ones of the
+    user (all the users for the staff) without an id."""
+
+    def get(self, request, id=None, *args, **kwargs):
+        qs = TranscodeJob.objects.all()
+        if not request.user.is_staff:
+            qs = qs.filter(user=request.user)
+        if id:
+            return JsonResponse(get_object_or_404(qs, id=id).as_dict())
+        status = request.GET.get('status')
+        if status:
+            qs = qs.filter(status=status)
+        return JsonResponse(
+            {'jobs': [j.as_dict() for j in qs.order_by('-created')[:100]]})
+
+
+class StreamStatsView(LoginRequiredMixin, View):
+    def get(self, request, *args, **kwargs):
+        stats = stream_stats.as_dict()
+        stats['pid'] = os.getpid()
+        stats['pacing'] = stream_pacer.as_dict()
+        return JsonResponse(stats)
+
+
 class QueryMediaFilesView(LoginRequiredMixin, View):
     def get(self, request, *args, **kwargs):
         agg_column = request.GET['to_chart'] or 'count'
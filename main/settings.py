@@ -128,6 +128,11 @@ USE_TZ = True
 STATIC_URL = '/static/'
 STATIC_ROOT = 'staticfiles'
 
+# Seconds collect_media waits for mediainfo (or ffprobe) on one file.
+COLLECT_MEDIA_TIMEOUT = 120
+# Rows collect_media inserts per statement (and transaction).
+COLLECT_MEDIA_BATCH_SIZE = 500
+
 VIDEO_EXTENSIONS = [
     'avi', 'mkv', 'rmvb', 'mpeg', 'mpg', 'mp4', 'h263p', 'h263', 'm4v', 'webm',
     '3gp', 'divx', 'ogv', 'wmv', 'mov', 'flv', 'rm', 'ts'
@@ -142,6 +147,109 @@ SENDFILE_BACKEND = 'sendfile.backends.simple'
 
 DEFAULT_VP8_CRF = 22
 
+# Finished transcodes are kept here. The least recently used files are
+# removed when the directory grows over TRANSCODE_CACHE_MAX_SIZE bytes.
+TRANSCODE_CACHE_DIR = os.path.join(BASE_DIR, 'cache')
+TRANSCODE_CACHE_MAX_SIZE = 50 * 2 ** 30
+
+# Viewers of the same transcode share one ffmpeg process. This is the most of
+# its output kept in memory for the viewers that are behind; the ones that
+# fall further behind read the transcode's temp file (ffmpeg never waits).
+TRANSCODE_SHARED_BUFFER_SIZE = 64 * 2 ** 20
+
+# Size of the blocks read from ffmpeg and sent to the viewers.
+STREAM_BLOCK_SIZE = 64 * 1024
+
+# Pacing. All the workers together send at most STREAM_MAX_RATE bytes per
+# second (None is no limit), downloads only use what the viewers leave. They
+# share it through the files in STREAM_PACING_DIR. A viewer of a file sent as
+# it is (the original or a cached transcode) gets STREAM_RATE_FACTOR times
+# its bitrate, after the first STREAM_BURST seconds of it sent at full speed.
+# DOWNLOAD_MAX_RATE limits every download (None is no limit).
+STREAM_MAX_RATE = None
+STREAM_PACING_DIR = os.path.join(BASE_DIR, 'pacing')
+STREAM_RATE_FACTOR = 1.5
+STREAM_BURST = 30  # seconds
+DOWNLOAD_MAX_RATE = None
+
+# Subtitles prepared for burning them in the video.
+SUBTITLES_CACHE_DIR = os.path.join(BASE_DIR, 'subtitles')
+SUBTITLES_CACHE_MAX_AGE = 30 * 24 * 3600  # seconds
+SUBTITLES_CACHE_MAX_SIZE = 500 * 2 ** 20
+
+# Background transcodes (generate file) are split at keyframes in chunks of
+# at least CHUNK_MIN_DURATION seconds that are encoded in parallel by
+# CHUNKED_ENCODING_WORKERS processes (None means one per core).
+CHUNKED_ENCODING = True
+CHUNKED_ENCODING_WORKERS = None
+CHUNK_MIN_DURATION = 120
+CHUNKS_DIR = os.path.join(BASE_DIR, 'chunks')
+
+# Max number of ffmpeg processes streaming at the same time in the host.
+# Requests wait TRANSCODE_QUEUE_TIMEOUT seconds for a free slot.
+TRANSCODE_SLOTS = 3
+TRANSCODE_SLOTS_DIR = os.path.join(BASE_DIR, 'slots')
+TRANSCODE_QUEUE_TIMEOUT = 30
+
+# Segmented (HLS) streaming. Segments are encoded on demand and kept here.
+SEGMENTS_DIR = os.path.join(TRANSCODE_CACHE_DIR, 'segments')
+SEGMENT_DURATION = 6  # seconds
+
+# Renditions offered in the HLS master playlist, the player switches between
+# them according to its throughput. Only the ones not wider than the file
+# (and the user's max_width) are listed, bandwidth is in bits per second.
+# An empty list streams a single rendition with the user's settings.
+RENDITIONS = [
+    {'name': '1080p', 'width': 1920, 'crf': 23, 'bandwidth': 6000000},
+    {'name': '720p', 'width': 1280, 'crf': 23, 'bandwidth': 3000000},
+    {'name': '480p', 'width': 854, 'crf': 25, 'bandwidth': 1200000},
+    {'name': '360p', 'width': 640, 'crf': 27, 'bandwidth': 700000},
+]
+
+# When a segment is encoded slower than REALTIME_MIN_SPEED times realtime,
+# the next segments of that session use the next of the ENCODER_LEVELS
+# (a faster x264 preset and/or a fraction of the width). After
+# REALTIME_RECOVER_SEGMENTS segments in a row encoded at REALTIME_RECOVER_SPEED
+# or faster it goes back to the previous level.
+REALTIME_MIN_SPEED = 1.5
+REALTIME_RECOVER_SPEED = 3.0
+REALTIME_RECOVER_SEGMENTS = 3
+ENCODER_LEVELS = [
+    {'preset': 'veryfast', 'scale': 1},
+    {'preset': 'superfast', 'scale': 1},
+    {'preset': 'ultrafast', 'scale': 1},
+    {'preset': 'ultrafast', 'scale': 0.75},
+    {'preset': 'ultrafast', 'scale': 0.5},
+]
+
+# When a viewer goes past PREWARM_AT of a file, the first PREWARM_DURATION
+# seconds of the next file of the directory are encoded (as HLS segments)
+# with the lowest priority, as long as the load average is under
+# PREWARM_MAX_LOAD per core and PREWARM_MIN_FREE_SPACE bytes are free.
+PREWARM = True
+PREWARM_AT = 0.5
+PREWARM_DURATION = 120  # seconds
+PREWARM_MAX_LOAD = 0.5
+PREWARM_MIN_FREE_SPACE = 10 * 2 ** 30
+
+# Background transcode jobs. Higher priorities run first and
+# TRANSCODE_JOB_WORKERS jobs run at the same time in process_tasks. A
+# running job that didn't report progress in TRANSCODE_JOB_STALE_AFTER
+# seconds is considered dead and can be submitted again.
+TRANSCODE_JOB_PRIORITIES = {'prewarm': 20, 'generate': 10}
+TRANSCODE_JOB_WORKERS = 2
+TRANSCODE_JOB_STALE_AFTER = 3600
+BACKGROUND_TASK_RUN_ASYNC = TRANSCODE_JOB_WORKERS > 1
+BACKGROUND_TASK_ASYNC_THREADS = TRANSCODE_JOB_WORKERS
+
+# Transcode and remux streams are handed to the asyncio stream server
+# (asgi_stream.py) when ASYNC_STREAM_URL is set, ie: '/astream/' proxied to
+# it. The server has to be started with the same ASYNC_STREAM_SECRET, a long
+# random string that is not in this file (ie: read it from the environment).
+ASYNC_STREAM_URL = None
+ASYNC_STREAM_SECRET = os.environ.get('ASYNC_STREAM_SECRET')
+ASYNC_STREAM_TOKEN_TTL = 300  # seconds
+
 # languages abbreviations
 LANGUAGES = {
     'spa': 'spanish',